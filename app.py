@@ -1,9 +1,10 @@
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 from dash import dash_table
 import dash_bootstrap_components as dbc
+import flask
 from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
 
@@ -13,7 +14,7 @@ import numpy as np
 import pandas as pd
 import scipy as sc
 from scipy import stats
-from scipy.stats import gaussian_kde
+from scipy.signal import fftconvolve
 
 from random import randint, choice, shuffle, sample, seed
 import warnings
@@ -28,6 +29,10 @@ import time
 from functools import reduce
 import operator
 
+from ibm import W, H, TRAITS, T_GROWTH, T_DISP, T_RESUSC, T_BMR, T_BMR_RED, T_EFF
+from sessions import SESSIONS, HISTORY_LENGTH, SERIES_COLUMNS, FRAME_BUDGET
+from metrics import METRICS
+
 #########################################################################################
 ################################# CONFIG APP ############################################
 #########################################################################################
@@ -44,21 +49,444 @@ app.config.suppress_callback_exceptions = True
 server = app.server
 
 
+@server.route('/metrics')
+def metrics():
+    """ Phase timings of all sessions, for scraping by Prometheus """
+    return flask.Response(METRICS.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 #########################################################################################
 ########################### CUSTOM FUNCTIONS ############################################
 #########################################################################################
 
-def get_kdens_choose_kernel(_list, kernel=0.5):
-    """ Finds the kernel density function across a sample of SADs """
-    density = gaussian_kde(_list)
-    n = len(_list)
-    #xs = np.linspace(0, 1, n)
-    xs = np.linspace(min(_list), max(_list), n)
-    density.covariance_factor = lambda : kernel
-    density._compute_covariance()
-    D = [xs,density(xs)]
+KDE_GRID = 512 # points at which kernel densities are evaluated
+
+
+def get_kdens_choose_kernel(_list, kernel=0.5, grid=KDE_GRID, weights=None):
+    """ Finds the kernel density function across a sample of SADs.
+
+        The Gaussian kernel has a bandwidth of `kernel` sample standard deviations, as
+        gaussian_kde with a fixed covariance_factor, or is chosen by Scott's or Silverman's
+        rule when kernel is 'scott' or 'silverman'. The sample is linearly binned onto
+        `grid` points and convolved with the kernel by FFT, which is O(n + grid log grid)
+        rather than O(n**2). Optional weights count each value as that many individuals,
+        as super-individuals do """
+    x = np.asarray(_list, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(x.shape[0])
+    weights = np.asarray(weights, dtype=np.float64)
+    n = weights.sum()
+    lo, hi = x.min(), x.max()
+    xs = np.linspace(lo, hi, grid)
+
+    if n > 1:
+        mean = (weights @ x) / n
+        sd = np.sqrt((weights @ (x - mean)**2) / (n - 1))
+    else:
+        sd = 0.0
+    if sd == 0 or hi == lo:
+        return [xs, np.zeros(grid)]
+
+    if kernel == 'scott':
+        kernel = n**(-1/5)
+    elif kernel == 'silverman':
+        kernel = (n * 3/4)**(-1/5)
+    bw = kernel * sd
+
+    # linear binning: each value is split between its two neighbouring grid points
+    delta = (hi - lo) / (grid - 1)
+    pos = (x - lo) / delta
+    i = np.minimum(pos.astype(np.int64), grid - 2)
+    w = pos - i
+    counts = (np.bincount(i, weights * (1 - w), grid)
+              + np.bincount(i + 1, weights * w, grid))
+
+    # the kernel is truncated at 4 bandwidths
+    L = min(grid - 1, int(np.ceil(4 * bw / delta)))
+    k = np.exp(-0.5 * (np.arange(-L, L + 1) * delta / bw)**2) / (n * bw * np.sqrt(2 * np.pi))
+    density = np.maximum(fftconvolve(counts, k, mode='same'), 0)
+    D = [xs, density]
     return D
-    
+
+
+# kernel densities of recent frames, by (session, epoch, tick, variable, bandwidth), and
+# fit statistics, by (session, epoch, tick, x-variable, y-variable)
+KDE_CACHE = {}
+FIT_CACHE = {}
+CACHE_SIZE = 64
+
+
+def cached(cache, key, compute):
+    """ Returns cache[key], computing and storing it first if needed. The oldest entry is
+        dropped once the cache holds CACHE_SIZE entries """
+    if key not in cache:
+        if len(cache) >= CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = compute()
+    return cache[key]
+
+
+class FitStats(object):
+    """ Sufficient statistics of x-y data for the polynomial (up to cubic) and power law
+        fits of the xy panel: moment sums of x**k and x**k * y, and the same sums of log x
+        and log y over pairs with x, y > 0, each pair counted by its weight if given, as
+        super-individuals are. They are gathered in one pass over the data,
+        after which each fit only solves a system of at most 4 normal equations, however
+        many individuals there are.
+
+        Raw power sums up to x**6 make the normal equations ill-conditioned once x is in
+        the hundreds, so the polynomial sums are of u = (x - x0) / scale and v = y - y0,
+        and the coefficients are transformed back to x and y. The shifts and scale are
+        fixed per FitStats, from the midpoints and half-range of the first data unless
+        given """
+
+    MAX_DEGREE = 3
+
+    def __init__(self, x0=None, scale=None, y0=None):
+        d = self.MAX_DEGREE
+        self.x0, self.scale, self.y0 = x0, scale, y0
+        self.sx = np.zeros(2*d + 1)  # sums of u**k
+        self.sxy = np.zeros(d + 1)   # sums of u**k * v
+        self.syy = 0.0
+        self.lx = np.zeros(3)        # sums of (log x)**k
+        self.lxy = np.zeros(2)       # sums of (log x)**k * log y
+        self.lyy = 0.0
+        self.x_range = [np.inf, -np.inf]
+
+    def update(self, x, y, w=None):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if x.shape[0] == 0:
+            return self
+        w = np.ones(x.shape[0]) if w is None else np.asarray(w, dtype=np.float64)
+        if self.x0 is None:
+            self.x0 = (x.min() + x.max()) / 2
+        if self.scale is None:
+            self.scale = (x.max() - x.min()) / 2 or 1.0
+        if self.y0 is None:
+            self.y0 = (y.min() + y.max()) / 2
+        u = (x - self.x0) / self.scale
+        v = y - self.y0
+        p = u[None, :] ** np.arange(2*self.MAX_DEGREE + 1)[:, None]
+        self.sx += p @ w
+        self.sxy += p[:self.MAX_DEGREE + 1] @ (w * v)
+        self.syy += (w * v) @ v
+
+        pos = (x > 0) & (y > 0)
+        lx, ly, lw = np.log(x[pos]), np.log(y[pos]), w[pos]
+        self.lx += [lw.sum(), lw @ lx, (lw * lx) @ lx]
+        self.lxy += [lw @ ly, (lw * lx) @ ly]
+        self.lyy += (lw * ly) @ ly
+
+        self.x_range = [min(self.x_range[0], x.min()), max(self.x_range[1], x.max())]
+        return self
+
+    @staticmethod
+    def _solve(A, b, n, sy, syy):
+        """ Least squares coefficients from the normal equations, and R-squared """
+        coefs = np.linalg.lstsq(A, b, rcond=None)[0]
+        sst = syy - sy**2 / n
+        sse = max(syy - coefs @ b, 0)
+        r2 = 1 - sse / sst if sst > 0 else np.nan
+        return coefs, r2
+
+    def fit(self, model):
+        """ Returns the coefficients (lowest order first) and R-squared of a fit, or None if
+            there are too few data. Power law fits y = a * x**b by linear regression of
+            log y on log x, and R-squared is for that regression """
+        if model == 'Power law':
+            n = self.lx[0]
+            if n < 2:
+                return None
+            A = np.array([[self.lx[0], self.lx[1]], [self.lx[1], self.lx[2]]])
+            (log_a, b), r2 = self._solve(A, self.lxy, n, self.lxy[0], self.lyy)
+            return np.array([np.exp(log_a), b]), r2
+
+        d = ['Linear', 'Quadratic', 'Cubic'].index(model) + 1
+        n = self.sx[0]
+        if n < d + 1:
+            return None
+        A = self.sx[np.add.outer(np.arange(d + 1), np.arange(d + 1))]
+        coefs, r2 = self._solve(A, self.sxy[:d + 1], n, self.sxy[0], self.syy)
+        # substitute u = (x - x0) / scale and add back y0
+        u = np.polynomial.Polynomial([-self.x0 / self.scale, 1 / self.scale])
+        c = np.polynomial.Polynomial(coefs)(u).coef
+        coefs = np.zeros(d + 1)
+        coefs[:c.shape[0]] = c
+        coefs[0] += self.y0
+        return coefs, r2
+
+
+def get_fit_curve(model, coefs, x_range, n=200):
+    """ Returns the x and y of a fitted curve across x_range """
+    lo, hi = x_range
+    if model == 'Power law':
+        x = np.linspace(max(lo, 0), hi, n)
+        x = x[x > 0]
+        return x, coefs[0] * x**coefs[1]
+    x = np.linspace(lo, hi, n)
+    return x, np.polyval(coefs[::-1], x)
+
+
+def get_fit_text(model, coefs, r2):
+    """ Formats a fitted equation and its R-squared """
+    if model == 'Power law':
+        eq = 'y = %.3g x<sup>%.3g</sup>' % tuple(coefs)
+    else:
+        terms = ['%.3g' % coefs[0], '%+.3g x' % coefs[1]]
+        terms += ['%+.3g x<sup>%d</sup>' % (c, k) for k, c in enumerate(coefs[2:], 2)]
+        eq = 'y = ' + ' '.join(terms)
+    return model + ': ' + eq + ' | R<sup>2</sup> = ' + str(np.round(r2, 3))
+
+
+# hover labels of individuals: (label, attribute) for per-individual attributes and
+# (label, trait) for species traits, which are looked up by species in the browser
+HOVER_ATTRIBUTES = [('Body size', 'size'),
+                    ('Resource quota', 'quota')]
+HOVER_TRAITS = [('BMR', T_BMR),
+                ('BMR reduction in dormancy', T_BMR_RED),
+                ('Resource use efficiency', T_EFF),
+                ('Resuscitation rate', T_RESUSC),
+                ('Active dispersal rate', T_DISP),
+                ('Growth rate', T_GROWTH)]
+
+
+def get_hover_template(inspect=False):
+    """ Hover template of the IBM animation. customdata[0] is the Ind ID, followed by the
+        hover attributes and traits unless individuals are inspected by clicking """
+    if inspect:
+        return 'Ind ID: %{customdata[0]}<br>Click for details<extra></extra>'
+    labels = [lab for lab, _ in HOVER_ATTRIBUTES + HOVER_TRAITS]
+    lines = ['%s: %%{customdata[%d]:.3f}' % (lab, i + 1) for i, lab in enumerate(labels)]
+    return '<br>'.join(lines) + '<extra></extra>'
+
+
+def get_inspect_text(state, ind_id):
+    """ Describes one individual of a state, found by its Ind ID """
+    i = np.flatnonzero(state.ind_id == ind_id)
+    if i.shape[0] == 0:
+        return 'Individual ' + str(ind_id) + ' is no longer in the system'
+    i = i[0]
+    text = ['Ind ID: ' + str(ind_id),
+            'Species ID: ' + str(state.species_id[i]),
+            'Age: ' + str(state.age[i]),
+            'Metabolic state: ' + ('active' if state.state[i] else 'dormant'),
+            'Individuals represented: ' + str(state.weight[i]),
+            'x, y: ' + str(np.round(state.x[i], 3)) + ', ' + str(np.round(state.y[i], 3))]
+    for lab, attr in HOVER_ATTRIBUTES:
+        text.append(lab + ': ' + str(np.round(getattr(state, attr)[i], 3)))
+    for lab, t in HOVER_TRAITS:
+        text.append(lab + ': ' + str(np.round(state.sp_traits[state.sp[i], t], 3)))
+    return ' | '.join(text)
+
+
+def encode_array(a, dtype):
+    """ Packs an array as a base64 string of little-endian values, to be decoded into a
+        JavaScript typed array in the browser """
+    return base64.b64encode(np.ascontiguousarray(a, dtype=dtype).tobytes()).decode('ascii')
+
+
+# populations larger than DISPLAY_POINTS are decimated for display, and frames of more
+# than WEBGL_POINTS individuals are drawn with Scattergl
+DISPLAY_POINTS = 20000
+WEBGL_POINTS = 2000
+DISPLAY_GRID = (20, 10) # cells along x and y used to stratify decimation
+DISPLAY_RNG = np.random.default_rng()
+
+
+def decimate(state, k, grid=DISPLAY_GRID, rng=DISPLAY_RNG):
+    """ Returns the sorted indices of about k individuals to display, or None to display all.
+
+        Individuals are stratified by the cells of a grid over the system, and each cell
+        keeps a share of k proportional to its abundance. Within a cell, every species gets
+        the same total weight, so rare species are kept far more often than under uniform
+        random sampling (weighted sampling without replacement by random keys) """
+    n = state.n
+    if n <= k:
+        return None
+
+    nx, ny = grid
+    cx = np.clip((state.x * (nx / W)).astype(np.int64), 0, nx - 1)
+    cy = np.clip((state.y * (ny / H)).astype(np.int64), 0, ny - 1)
+    cell = cx * ny + cy
+
+    # individuals of a species in a cell share a weight of 1; a key of log(u)/w with
+    # w = 1/count ranks them for weighted sampling without replacement
+    group = cell * state.sp_ids.shape[0] + state.sp
+    key = np.log(rng.random(n)) * np.bincount(group)[group]
+
+    n_cell = np.bincount(cell, minlength=nx*ny)
+    quota = np.ceil(k * n_cell / n).astype(np.int64)
+    start = np.cumsum(n_cell) - n_cell
+
+    # sort by cell, and by key (largest first) within cells
+    order = np.argsort(cell - np.expm1(key))
+    rank = np.arange(n) - start[cell[order]]
+    return np.sort(order[rank < quota[cell[order]]])
+
+
+def get_frame_payload(state, tick, plot_by, inspect=False):
+    """ Packs the individuals of a state into a compact frame for the clientside renderer
+        in assets/resizing.js: positions and marker sizes as float32, species rows and
+        symbol codes as unsigned ints, and a palette of species IDs that species rows index.
+        Hover values are sent as numbers and formatted by the hover template in the browser;
+        in inspect mode only Ind IDs are sent and details are fetched on click.
+
+        Large populations are decimated for display (see decimate); n is the number of
+        individuals drawn and total the number in the system """
+
+    idx = decimate(state, DISPLAY_POINTS)
+    pick = lambda a: a if idx is None else a[idx]
+
+    if plot_by == 'resource quota':
+        s = pick(state.quota)
+    else:
+        s = pick(state.size)
+
+    n = s.shape[0]
+    return dict(tick = tick,
+                n = n,
+                total = state.n,
+                gl = n > WEBGL_POINTS,
+                x = encode_array(pick(state.x), '<f4'),
+                y = encode_array(pick(state.y), '<f4'),
+                size = encode_array(4 + s**0.75, '<f4'),
+                sp = encode_array(pick(state.sp), '<u4'),
+                symbol = encode_array(pick(state.symbol), '|u1'),
+                palette = encode_array(state.sp_ids, '<u4'),
+                ind_id = encode_array(pick(state.ind_id), '<u4'),
+                hover = [] if inspect else
+                        [encode_array(pick(getattr(state, a)), '<f4') for _, a in HOVER_ATTRIBUTES],
+                hover_traits = [] if inspect else
+                               [encode_array(state.sp_traits[:, t], '<f4') for _, t in HOVER_TRAITS],
+                hovertemplate = get_hover_template(inspect))
+
+
+def get_animation_figure():
+    """ Builds the empty IBM animation figure; frames are drawn into it in the browser """
+
+    axis = dict(
+        title = dict(
+            text = None,
+            font = dict(
+                family = '"Open Sans", "HelveticaNeue", "Helvetica Neue",'
+                " Helvetica, Arial, sans-serif",
+                size = 18,
+            ),
+        ),
+        visible = False,
+        rangemode = "tozero",
+        zeroline = True,
+        showticklabels = False,
+    )
+
+    figure = go.Figure(
+            data = {},
+            layout = go.Layout(
+                xaxis = dict(axis),
+                yaxis = dict(axis),
+                margin = dict(l=0, r=0, b=0, t=0),
+                showlegend = False,
+                height = 500,
+                paper_bgcolor = "rgb(245, 247, 249)",
+                plot_bgcolor = "rgb(245, 247, 249)",
+            ),
+        )
+
+    figure.update_xaxes(range=[0, W])
+    figure.update_yaxes(range=[0, H])
+    return figure
+
+
+# time series variables and their columns in a session's series
+SERIES_VARIABLES = {'Total abundance (N)': SERIES_COLUMNS.index('N'),
+                    'Species richness (S)': SERIES_COLUMNS.index('S'),
+                    'Total resources': SERIES_COLUMNS.index('R')}
+
+
+# bounds (ms) of the adaptive interval between requests for frames
+MIN_INTERVAL = 50
+MAX_INTERVAL = 2000
+
+
+def get_calls_text(N, calls):
+    """ Agents in the latest frame and calls of every callback and model step per tick of
+        the interval (run_model), which should be at most 1 for frames drawn """
+    text = [] if N is None else ['agents = ' + str(N)]
+    ticks = calls.get('run_model', 0)
+    if ticks > 0:
+        text.append('per tick: ' + ', '.join('%s %.2f' % (k, v/ticks) for k, v in sorted(calls.items())
+                                             if k != 'run_model'))
+    return ' | '.join(text)
+
+
+def get_rate_text(session):
+    """ Time steps simulated per second and frames the browser did not keep up with """
+    rate = session.worker.tick_rate if session.worker is not None else 0
+    return '%.1f ticks/s | %d dropped frames' % (rate, session.dropped)
+
+
+def get_latest_frame(sid):
+    """ Returns the latest frame of a session and the session's epoch, or (None, None) if
+        the session has no individuals """
+    session = SESSIONS.get(sid)
+    if session is None:
+        return None, None
+    with session.lock:
+        frame, epoch = session.frame, session.epoch
+    if frame is None or frame.state.n == 0:
+        return None, None
+    return frame, epoch
+
+
+# per-individual attributes of the distribution and xy panels, by label; other labels
+# are species traits
+VARIABLE_ATTRIBUTES = {'resource quota': 'quota',
+                       'body size': 'size'}
+
+
+def get_variable(state, var_lab):
+    """ Values of a trait or attribute for every individual of a state, read straight from
+        its arrays """
+    if var_lab in VARIABLE_ATTRIBUTES:
+        return np.asarray(getattr(state, VARIABLE_ATTRIBUTES[var_lab]), dtype=np.float64)
+    return state.trait(TRAITS.index(var_lab))
+
+
+def get_session_density(sid, var_lab, kernel):
+    """ Returns the kernel density of a variable across the individuals of the latest frame
+        of a session, or None if there are none. Densities are memoized per tick, so repeated
+        requests while the model is paused cost nothing """
+    frame, epoch = get_latest_frame(sid)
+    if frame is None:
+        return None
+
+    def compute():
+        with METRICS.timer('kde', sid, frame.state.n):
+            x = get_variable(frame.state, var_lab)
+            ok = np.isfinite(x)
+            return get_kdens_choose_kernel(x[ok], kernel, weights=frame.state.weight[ok])
+    return cached(KDE_CACHE, (sid, epoch, frame.tick, var_lab, kernel), compute)
+
+
+def get_session_xy(sid, x_var, y_var):
+    """ Returns the x-y data of the latest frame of a session and their FitStats, or None if
+        there are no individuals. FitStats are memoized per tick, so switching between
+        models only re-solves the fit """
+    frame, epoch = get_latest_frame(sid)
+    if frame is None:
+        return None
+
+    x = get_variable(frame.state, x_var)
+    y = get_variable(frame.state, y_var)
+    ok = np.isfinite(x) & np.isfinite(y)
+    x, y, w = x[ok], y[ok], frame.state.weight[ok]
+    def compute():
+        with METRICS.timer('fit_stats', sid, frame.state.n):
+            return FitStats().update(x, y, w)
+    fit_stats = cached(FIT_CACHE, (sid, epoch, frame.tick, x_var, y_var), compute)
+    return x, y, fit_stats
+
 #########################################################################################
 #################### DASH APP CONTROL CARDS  ############################################
 #########################################################################################
@@ -277,7 +705,7 @@ def control_card1():
             html.I(className="fas fa-question-circle fa-lg", id="target_ibm_controls",
                 style={'display': 'inline-block', 'width': '20%', 'color':'#99ccff'},
                 ),
-            dbc.Tooltip("IBMs will run more slowly with several thousands of individuals. You can rarefy to 1,000 randomly chosen individuals to stop run-away growth. You should parameterize a system that fluctuates below 5K individuals or at no more than 10K.", target="target_ibm_controls",
+            dbc.Tooltip("Save writes the complete IBM, including its time series and settings, to a file that can be restored later to continue the run. IBMs will run more slowly with tens of thousands of individuals. Above 20,000 individuals, the animation shows a subset chosen across the whole system and across species; the totals shown are always exact. You should parameterize a system that fluctuates below 50K individuals.", target="target_ibm_controls",
                 style = {'font-size': 12},
                 ),
                 
@@ -303,13 +731,89 @@ def control_card1():
                     
             },
             ),
-            html.Button('Rarefy to 1K', id='btn-rarefy', n_clicks=0,
+            html.Button('Save', id='btn-save', n_clicks=0,
             style={'width': '45%',
                     'display': 'inline-block',
                     'margin-right': '2%',
-                    #'margin-left': '3%',
             },
             ),
+            dcc.Download(id='checkpoint_download'),
+            html.Hr(),
+            dcc.Upload(id='checkpoint_upload',
+                children=html.Button('Restore saved IBM',
+                    style={'display': 'inline-block',
+                            'margin-left': '3%',
+                    },
+                ),
+                accept='.npz',
+            ),
+            html.Hr(),
+            html.Div(
+            id="Ticks per frame",
+                children=[
+                        html.P('Time steps per frame', style={'display': 'inline-block',
+                                                       'font-size': 17,
+                                                       'width': '80%'},
+                                                      ),
+                        html.I(className="fas fa-question-circle fa-lg", id="target6",
+                            style={'display': 'inline-block', 'width': '20%', 'color':'#cccccc'},
+                            ),
+                        dbc.Tooltip("Number of time steps simulated before the animation is redrawn. Time series still record every time step. Increase this to advance large or slow IBMs faster.", target="target6",
+                            style = {'font-size': 12},
+                            ),
+                        dcc.Input(id='ticks_per_frame',
+                            type='number',
+                            value=1,
+                            min=1, max=100, step=1),
+                        ],
+                style={'width': '50%',
+                        'display': 'inline-block',
+                },
+            ),
+            html.Div(
+            id="Consumption radius",
+                children=[
+                        html.P('Consumption radius', style={'display': 'inline-block',
+                                                       'font-size': 17,
+                                                       'width': '80%'},
+                                                      ),
+                        html.I(className="fas fa-question-circle fa-lg", id="target7",
+                            style={'display': 'inline-block', 'width': '20%', 'color':'#cccccc'},
+                            ),
+                        dbc.Tooltip("Distance within which individuals can consume resource particles. At 0, resources are pooled and shared by all active individuals wherever they are.", target="target7",
+                            style = {'font-size': 12},
+                            ),
+                        dcc.Input(id='consumption_radius',
+                            type='number',
+                            value=0,
+                            min=0, max=W, step=0.5),
+                        ],
+                style={'width': '50%',
+                        'display': 'inline-block',
+                },
+            ),
+            html.Div(
+            id="Max agents",
+                children=[
+                        html.P('Super-individuals', style={'display': 'inline-block',
+                                                       'font-size': 17,
+                                                       'width': '80%'},
+                                                      ),
+                        html.I(className="fas fa-question-circle fa-lg", id="target8",
+                            style={'display': 'inline-block', 'width': '20%', 'color':'#cccccc'},
+                            ),
+                        dbc.Tooltip("Largest number of agents simulated. Beyond it, individuals of the same species and in a similar state are merged into super-individuals that each stand for many individuals, so very large populations can be simulated at a bounded cost. N and S remain exact. At 0, every individual is simulated.", target="target8",
+                            style = {'font-size': 12},
+                            ),
+                        dcc.Input(id='max_agents',
+                            type='number',
+                            value=0,
+                            min=0, step=1000),
+                        ],
+                style={'width': '50%',
+                        'display': 'inline-block',
+                },
+            ),
             ],
         )
 
@@ -367,7 +871,18 @@ def distribution_1():
                         options=[{"label": i, "value": i} for i in ['growth rate', 'active dispersal rate', 'resuscitation rate', 'basal metabolic rate', 'bmr reduction in dormancy', 'immigration rate', 'resource quota', 'body size']],
                         value=None,
                         style={'display': 'inline-block',
-                            'width': '80%',
+                            'width': '45%',
+                            'font-size': "100%"},
+                        ),
+                    dcc.Dropdown(
+                        id='kde_bandwidth',
+                        options=[{"label": 'bandwidth: 0.5 SD', "value": 0.5},
+                                 {"label": "bandwidth: Scott's rule", "value": 'scott'},
+                                 {"label": "bandwidth: Silverman's rule", "value": 'silverman'}],
+                        value=0.5,
+                        clearable=False,
+                        style={'display': 'inline-block',
+                            'width': '35%',
                             'font-size': "100%"},
                         ),
                     html.Button('Plot', id='btn5', n_clicks=0,
@@ -462,6 +977,26 @@ def xy_1():
           'margin-right': '0px','margin-left': '0px','height': '600px', #'display': 'inline-block',
           },
           )
+
+def performance_1():
+    return html.Div(id="right-column5", className="one columns",
+    children=[
+        html.H5("Performance"),
+        html.P("Moving average time of each phase of simulating and drawing this session",
+               style={'font-size': 14, 'margin-bottom': '0px'}),
+        html.Hr(),
+        dcc.Graph(id='performance_fig', style={'width': '100%', 'background-color': '#f0f0f0','padding': '0px', 'margin-bottom': '0px', 'margin-right': '0px','margin-left': '0px','height': '440px',
+        },),
+        dcc.Interval(
+            id='metrics_interval',
+            interval = 2000,
+            n_intervals = 0,
+        ),
+        ],
+        style={'width': '100%', 'background-color': '#f0f0f0','padding': '0px', 'margin-bottom': '0px',
+        'margin-right': '0px','margin-left': '0px','height': '600px',
+        },
+        )
 #########################################################################################
 ############################### IBM ANIMATION CARD ######################################
 #########################################################################################
@@ -480,15 +1015,18 @@ def xy_1():
 
 app.layout = html.Div([
     
-    dcc.Store(id='main_df', storage_type='memory'),
-    dcc.Store(id='species', storage_type='memory'),
-    dcc.Store(id='resources', storage_type='memory'),
+    # simulation state is held on the server; the browser only keeps the session ID
+    # and the number of time steps simulated so far
+    dcc.Store(id='session_id', storage_type='memory'),
+    dcc.Store(id='tick', storage_type='memory'),
+    dcc.Store(id='frame', storage_type='memory'),
     
-    html.Div(id='placeholder1', style={'display': 'none'}),
+    # parameters last sent to the session's worker, which steps the model with them
+    dcc.Store(id='params', storage_type='memory'),
     
-    html.Div(id='N_ls', style={'display': 'none'}),
-    html.Div(id='S_ls', style={'display': 'none'}),
-    html.Div(id='R_ls', style={'display': 'none'}),
+    # N, S and total resources are streamed into time_series_fig from the session's
+    # time series; the [session ID, epoch] changes whenever the series is reset
+    dcc.Store(id='series_epoch', storage_type='memory'),
     
     html.Div(
             style={'background-color': '#f9f9f9'},
@@ -545,14 +1083,31 @@ app.layout = html.Div([
                                     ],
                                     style={'display': 'inline-block', 'vertical-align': 'top',
                                             'margin-right': '40px', 'width': '30%'},),
+                                html.Div(
+                                    id="hover_mode_box",
+                                    children=[
+                                    html.B("Hover details",
+                                        style={'display': 'inline-block', 'width': '100%',
+                                    },),
+                                    dcc.RadioItems(
+                                        id='hover_mode',
+                                        options=[{"label": i, "value": i} for i in [' all', ' click to inspect']],
+                                        value=' all',
+                                        ),
+                                    ],
+                                    style={'display': 'inline-block', 'vertical-align': 'top',
+                                            'margin-right': '40px', 'width': '20%'},),
                                 html.Div(
                                     id="update_text_box1",
-                                    children=[html.H6(id='Nc_S_R')],
+                                    children=[html.H6(id='Nc_S_R'),
+                                              html.P(id='tick_rate', style={'font-size': 12, 'margin-bottom': '0px'}),
+                                             ],
                                     style={'display': 'inline-block'},
                                     ),
+                                html.P(id='inspect_text', style={'font-size': 12, 'margin-bottom': '0px'}),
                                     
                                 html.Hr(),
-                                dcc.Graph(id='model_animation_fig')],
+                                dcc.Graph(id='model_animation_fig', figure=get_animation_figure())],
                                 
                             style={'background-color': '#f0f0f0', 'padding': '0px',
                                 'margin-bottom': '0px', 'margin-right': '0px',
@@ -560,7 +1115,7 @@ app.layout = html.Div([
                           ),
                           dcc.Interval(
                               id='interval',
-                              interval = 200,
+                              interval = int(1e3*FRAME_BUDGET),
                               n_intervals = 0,
                               max_intervals = 1,
                               disabled = True,
@@ -613,6 +1168,17 @@ app.layout = html.Div([
                 'margin-bottom': '10px'},
     ),
     
+    html.Div(id="performance_1", className="one columns",
+        children=[performance_1()],
+        style={'width': '47%',
+                'display': 'inline-block',
+                'border-radius': '15px',
+                'box-shadow': '1px 1px 1px grey',
+                'background-color': '#f0f0f0',
+                'padding': '10px',
+                'margin-bottom': '10px'},
+    ),
+    
 ])
 
 
@@ -621,511 +1187,279 @@ app.layout = html.Div([
 #########################################################################################
 
 @app.callback([Output('interval', 'disabled'),
-               Output('main_df', 'clear_data'),
-               Output('species', 'clear_data'),
-               Output('resources', 'clear_data'),
+               Output('session_id', 'data'),
                Output('btn2', 'n_clicks'),
                Output('btn3', 'n_clicks'),
                Output('btn4', 'n_clicks'),
+               Output('S', 'value'),
+               Output('Q', 'value'),
+               Output('R', 'value'),
+               Output('immigration', 'value'),
+               Output('immigration_on_off', 'value'),
+               Output('reproduction_on_off', 'value'),
+               Output('death_on_off', 'value'),
+               Output('active_dispersal_on_off', 'value'),
+               Output('ticks_per_frame', 'value'),
+               Output('consumption_radius', 'value'),
+               Output('max_agents', 'value'),
                ],
-              [Input('btn1', 'n_clicks')],
+              [Input('btn1', 'n_clicks'),
+               Input('checkpoint_upload', 'contents')],
+              [State('session_id', 'data')],
               prevent_initial_call=True,
     )
-def update_df(n_clicks1):
-    return False, True, True, True, 0, 0, 0
+def update_df(n_clicks1, contents, sid):
+    trigger = dash.callback_context.triggered[0]['prop_id']
+    if not trigger.startswith('checkpoint_upload'):
+        SESSIONS.drop(sid)
+        return [False, SESSIONS.create(), 0, 0, 0] + [dash.no_update]*11
+    if contents is None:
+        raise PreventUpdate
+    
+    # continue a saved IBM in a new session, and set the controls to its parameters. The
+    # old session is only dropped once the checkpoint has been read, so a file that can't
+    # be read leaves the running IBM as it was
+    new_sid = SESSIONS.create()
+    try:
+        data = base64.b64decode(contents.split(',', 1)[1])
+        p = SESSIONS.get(new_sid).restore(io.BytesIO(data))
+    except Exception:
+        SESSIONS.drop(new_sid)
+        raise PreventUpdate
+    SESSIONS.drop(sid)
+    on_off = lambda b: ' on' if b else ' off'
+    return [False, new_sid, 0, 0, 0, p['S'], p['Q'], p['R0'], p['immigration'],
+            on_off(p['immigration_on']), on_off(p['reproduction_on']),
+            on_off(p['death_on']), on_off(p['dispersal_on']), p['ticks'],
+            p['consumption_radius'], p['max_agents']]
 
 
+@app.callback(Output('checkpoint_download', 'data'),
+              [Input('btn-save', 'n_clicks')],
+              [State('session_id', 'data')],
+              prevent_initial_call=True,
+    )
+def save_checkpoint(n_clicks, sid):
+    session = SESSIONS.get(sid)
+    frame = session.frame if session is not None else None
+    if frame is None:
+        raise PreventUpdate
+    return dcc.send_bytes(session.save, 'ibm_tick%d.npz' % frame.tick)
 
 
-@app.callback(Output('placeholder1', 'children'),
-              [Input('interval', 'n_intervals'),
-               ],
-             prevent_initial_call=True,
-        )
-def update_df(n):
-    return n
-        
-    
 
-@app.callback([Output('model_animation_fig', 'figure'),
-               Output('main_df', 'data'),
-               Output('species', 'data'),
-               Output('resources', 'data'),
-               Output('Nc_S_R', 'children'),
-               Output('N_ls', 'children'),
-               Output('S_ls', 'children'),
-               Output('R_ls', 'children'),
-               Output('interval', 'max_intervals'),
-               Output('btn-rarefy', 'n_clicks'),
-               ],
-              [Input('interval', 'disabled'),
-               Input('interval', 'max_intervals'),
-               Input('placeholder1', 'children'),
-               Input('model_animation_fig', 'figure'),
-               Input('main_df', 'data'),
-               Input('species', 'data'),
-               Input('resources', 'data'),
+
+@app.callback(Output('params', 'data'),
+              [Input('session_id', 'data'),
                Input('S', 'value'),
                Input('Q', 'value'),
                Input('R', 'value'),
                Input('btn2', 'n_clicks'),
                Input('btn3', 'n_clicks'),
-               Input('plot_by', 'value'),
                Input('immigration', 'value'),
                Input('immigration_on_off', 'value'),
                Input('reproduction_on_off', 'value'),
                Input('death_on_off', 'value'),
                Input('active_dispersal_on_off', 'value'),
-               Input('N_ls', 'children'),
-               Input('S_ls', 'children'),
-               Input('R_ls', 'children'),
-               Input('btn-rarefy', 'n_clicks'),
+               Input('consumption_radius', 'value'),
+               Input('max_agents', 'value'),
+               Input('ticks_per_frame', 'value'),
               ],
             )
-def run_model(disabled, max_n, ph1, main_fig, individuals, species, resources, S, Q, R0, n_clicks2, n_clicks3, plot_by, immigration_rate, imm_toggle, repr_toggle, death_toggle, act_disp_toggle, N1, S1, R1, n_clicks4):
+def send_commands(sid, S, Q, R0, n_clicks2, n_clicks3, immigration_rate, imm_toggle, repr_toggle, death_toggle, act_disp_toggle, radius, max_agents, ticks):
     
-    if disabled == True:
+    session = SESSIONS.get(sid)
+    if session is None:
         raise PreventUpdate
-        
-    w = 100
-    h = 50
-    N = 1000
+    METRICS.count('send_commands', sid)
     
+    if S is None or math.isnan(S) == True or S < 1:
+        S = 1
     if Q is None or math.isnan(Q) == True:
         Q = 1
     if R0 is None or math.isnan(R0) == True:
         R0 = 0
+    if immigration_rate is None or math.isnan(immigration_rate) == True:
+        immigration_rate = 0
+    if ticks is None or ticks < 1:
+        ticks = 1
+    if radius is None or radius < 0:
+        radius = 0
+    if max_agents is None or max_agents < 0:
+        max_agents = 0
     
-    if resources is None:
-        resources = pd.DataFrame(columns=['Resource ID', 'x_coord', 'y_coord', 'size'])
-
-    else:
-        resources = pd.read_json(resources)
-        
-    R = 0
-    if resources.shape[0] > 0:
-        R = np.sum(resources['size'])
-        
-    fig_data ={}
-    figure = go.Figure(
-            data = fig_data,
-            layout = go.Layout(
-                
-                xaxis = dict(
-                    title = dict(
-                        text = None,
-                        font = dict(
-                            family = '"Open Sans", "HelveticaNeue", "Helvetica Neue",'
-                            " Helvetica, Arial, sans-serif",
-                            size = 18,
-                        ),
-                    ),
-                    visible=False,
-                    showticklabels = False,
-                ),
-                                
-                yaxis = dict(
-                    title = dict(
-                        text = None,
-                        font = dict(
-                            family = '"Open Sans", "HelveticaNeue", "Helvetica Neue",'
-                            " Helvetica, Arial, sans-serif",
-                            size = 18,
-                        ),
-                    ),
-                    visible=False,
-                    showticklabels = False,
-                ),
-                                
-                margin = dict(l=0, r=0, b=0, t=0),
-                showlegend = False,
-                height = 500,
-                paper_bgcolor = "rgb(245, 247, 249)",
-                plot_bgcolor = "rgb(245, 247, 249)",
-            ),
-        )
+    # parameter changes and button presses only become commands to the worker, which
+    # applies them before its next step; they never step the model or redraw anything
+    params = dict(S = int(S),
+                  Q = Q,
+                  R0 = R0,
+                  immigration = immigration_rate,
+                  immigration_on = imm_toggle == ' on',
+                  reproduction_on = repr_toggle == ' on',
+                  death_on = death_toggle == ' on',
+                  dispersal_on = act_disp_toggle == ' on',
+                  consumption_radius = radius,
+                  max_agents = int(max_agents),
+                  ticks = int(ticks))
     
-    figure.update_xaxes(range=[0, w])
-    figure.update_yaxes(range=[0, h])
+    worker = session.start_worker(params)
+    worker.send('params', params)
+    worker.send('clear', n_clicks3 & 1)
+    worker.send('pause', n_clicks2 & 1)
+    return params
     
-    if n_clicks3 & 1 == True:
-        Nc_S_R = 'N = 0' + ' | ' + 'S = 0' + ' | ' + 'Total resources = 0'
-        return figure, None, None, None, Nc_S_R, [0], [0], [0], max_n + 1, 0
     
-    if n_clicks2 & 1 == True:
-        raise PreventUpdate
 
-    if species is None:
-        # declare initial dataframe
-        species = pd.DataFrame(columns=['Species ID'])
-        
-        # assign species IDs and traits
-        species['Species ID'] = np.random.randint(0, 0xFFFFFF, size=S)
-        species['growth rate'] = np.random.uniform(0.001, 1, size=S)
-        species['active dispersal rate'] = np.random.uniform(0, 20, size=S)
-        species['resuscitation rate'] = np.random.uniform(0.001, 1, size=S)
-        species['basal metabolic rate'] = np.random.uniform(0.001, 1, size=S)
-        species['bmr reduction in dormancy'] = np.random.uniform(0.001, 1, size=S)
-        species['immigration rate'] = np.random.uniform(0.001, 1, size=S) #1 - species['active dispersal rate']/np.sum(species['active dispersal rate'])
-        
-        for i in list(range(1, 2)):
-            species['resource efficiency ' + str(i)] = np.random.uniform(0.001, 1, size=S)
-        
-        sp_ids = species['Species ID'].tolist()
-        clrs = []
-        for id in sp_ids:
-            clr = "#" + "%06x" % id
-            clrs.append(clr)
-        species['color'] = clrs
-        
-    else:
-        species = pd.read_json(species)
-            
-    if individuals is None: # add condition
-        individuals = species.copy(deep=True)
-        individuals['Ind ID'] = list(range(S))
-        individuals['age'] = [0] * individuals.shape[0]
-        individuals['x_coord'] = 0
-        individuals['y_coord'] = np.random.uniform(0, h, size=S)
-        individuals['resource quota'] = 10 #np.random.uniform(0, 100, size=S)
-        individuals['body size'] = [10]*S
-        individuals['metabolic state'] = [1] * S # 0 = dormant, 1 = active
-            
-    elif individuals is None: # add condition
-        individuals = species.copy(deep=True)
-        individuals = individuals[individuals['growth rate'] < 0]
-        
-    else:
-        individuals = pd.read_json(individuals)
-        if individuals.shape[0] == 0:
-            raise PreventUpdate
-            
-    ####################################################
-    ########### SIMULATE RESOURCE INFLOW ###############
-    ####################################################
-    
-    r2 = pd.DataFrame(columns=['Resource ID', 'x_coord', 'y_coord', 'size'])
-    r2['Resource ID'] = [1]
-    r2['x_coord'] = 0
-    r2['y_coord'] = np.random.uniform(0, h, size=1)
-    r2['size'] = [R0*Q]
-    resources = pd.concat([resources, r2], ignore_index=True)
+@app.callback([Output('tick', 'data'),
+               Output('Nc_S_R', 'children'),
+               Output('tick_rate', 'children'),
+               Output('time_series_fig', 'extendData'),
+               Output('series_epoch', 'data'),
+               Output('interval', 'interval'),
+               Output('interval', 'max_intervals'),
+               ],
+              [Input('interval', 'n_intervals')],
+              [State('session_id', 'data'),
+               State('tick', 'data'),
+               State('plot_by2', 'value'),
+               State('series_epoch', 'data'),
+              ],
+              prevent_initial_call=True,
+            )
+def run_model(n_intervals, sid, last_tick, series_var, last_epoch):
     
-    ####################################################
-    ############## SIMULATE IMMIGRATION ################
-    ####################################################
+    # every tick of the interval fetches the newest frame the worker has published, which
+    # draw_frame then draws once; the worker runs on its own, so a slow or hidden tab
+    # only drops frames. The interval stops at max_intervals, which only this callback
+    # raises, so the next tick waits until this one has returned
+    start = time.time()
+    next_tick = n_intervals + 1
     
-    if immigration_rate > 0 and imm_toggle == ' on':
-        im = int(immigration_rate*Q)
-        
-        maxID = 0
-        if individuals.shape[0] > 0:
-            maxID = 1 + np.max(individuals['Ind ID'])
-            
-        if im > 0:
-            i2 = species.sample(n=im, replace=True, weights=species['immigration rate'])
-            i2['Ind ID'] = list(range(im))
-            i2['Ind ID'] = i2['Ind ID'] + maxID
-            i2['age'] = [0] * i2.shape[0]
-            i2['x_coord'] = 0
-            i2['y_coord'] = np.random.uniform(0, h, size=im)
-            i2['resource quota'] = 10
-            i2['body size'] = [10]*im
-            i2['metabolic state'] = [1] * im
-            individuals = pd.concat([individuals, i2], ignore_index=True)
+    session = SESSIONS.get(sid)
+    if session is None or not session.polling.acquire(blocking=False):
+        return [dash.no_update]*6 + [next_tick]
+    METRICS.count('run_model', sid)
     
-    ####################################################
-    ### SIMULATE PROCESSES AMONG ACTIVE INDIVIDUALS ####
-    ####################################################
+    try:
+        with METRICS.timer('fetch', sid) as t:
+            frame, rows, epoch = session.fetch(last_tick)
+            t.n = frame.state.n if frame is not None else None
+    finally:
+        session.polling.release()
     
-    df = []
-    if individuals.shape[0] > 0:
-        individuals = individuals[individuals['resource quota'] >= 0]
-        individuals['x_coord'] = individuals['x_coord'] + (Q*0.01)*w
-        
-        df_a = individuals[individuals['metabolic state'] == 1]
-        
-        n = df_a.shape[0]
-        if n > 0:
-            
-            # resource consumption
-            if resources.shape[0] > 0:
-                res = resources['size']
-                res_weights = res/np.sum(res)
-                
-                R = np.sum(res)
-                r_per_capita = R/n
-                D = R#/(w)
-                p = np.random.binomial(1, D/(1 + D), size=n)
-                total_consumed = np.minimum(r_per_capita, df_a['resource efficiency 1'] * df_a['body size']) * p
-                df_a['resource quota'] = df_a['resource quota'] + total_consumed
-                
-                R -= np.sum(total_consumed)
-                if R < 0:
-                    R = 0
-                    
-                resources['size'] = R*res_weights
-            
-            # growth
-            g = np.minimum(df_a['body size'] * df_a['growth rate'], df_a['resource quota'])
-            df_a['body size'] = df_a['body size'] + g #* df_a['metabolic state']
-            df_a['resource quota'] = df_a['resource quota'] - g #* df_a['metabolic state']
-            
-            # active dispersal inside the system
-            if act_disp_toggle == ' on':
-                d = np.minimum(df_a['x_coord'], df_a['active dispersal rate'])
-                d = np.minimum(d, df_a['resource quota'])
-                df_a['x_coord'] = df_a['x_coord'] - d
-                df_a['resource quota'] = df_a['resource quota'] - d/w
-            
-            # active maintenance
-            df_a['resource quota'] = df_a['resource quota'] - df_a['basal metabolic rate']
-            
-            # increase age
-            df_a['age'] = df_a['age'] + 1
-            
-            # death
-            if death_toggle == ' on':
-                df_a = df_a[df_a['resource quota'] >= 0]
-            
-            # outflow of active individuals
-            if df_a.shape[0] > 0:
-                df_a = df_a[df_a['x_coord'] <= w]
-            
-
-            n = df_a.shape[0]
-            if n > 0:
-                df_a['resource quota'] = df_a['resource quota'].apply(lambda x : x if x > 0 else 0)
-                df_a['resource quota'].fillna(0, inplace=True)
-                
-                # reproduction
-                if repr_toggle == ' on':
-                    ri = df_a['resource quota']/df_a['basal metabolic rate']
-                    p = ri/(1 + ri) * df_a['body size']/(20 + df_a['body size']) * df_a['age']/(20 + df_a['age'])
-                    df_a['reproduce'] = p
-                    df_a['reproduce'].replace(np.inf, 0, inplace=True)
-                    df_a['reproduce'].replace(-np.Inf, 0, inplace=True)
-                    df_a['reproduce'].fillna(0, inplace=True)
-                    
-                    x = df_a['reproduce'].tolist()
-                    df_a['reproduce'] = np.random.binomial(1, df_a['reproduce'], size = n)
-                    
-                    reproduce_no = df_a[df_a['reproduce'] == 0]
-                    reproduce_no.drop(labels=['reproduce'], axis=1, inplace=True)
-                    
-                    reproduce_yes = df_a[df_a['reproduce'] == 1]
-                    reproduce_yes.drop(labels=['reproduce'], axis=1, inplace=True)
-                    
-                    if reproduce_yes.shape[0] > 0:
-                        reproduce_yes['body size'] = reproduce_yes['body size']/2
-                        reproduce_yes['resource quota'] = reproduce_yes['resource quota']/2
-                        progeny = reproduce_yes.copy(deep=True)
-                        progeny['age'] = 0
-                        progeny['Ind ID'] = progeny['Ind ID'] + np.max(individuals['Ind ID'])
-                        
-                        progeny['y_coord'] = progeny['y_coord'] + np.random.uniform(-1, 1, size=progeny.shape[0])
-                        progeny['y_coord'].values[progeny['y_coord'].values < 0] = 0
-                        progeny['y_coord'].values[progeny['y_coord'].values > h] = h
-                        
-                        # merge dataframes of active individuals
-                        df_a = pd.concat([reproduce_no, reproduce_yes, progeny], ignore_index=True)
-                    else:
-                        df_a = pd.concat([reproduce_no, reproduce_yes], ignore_index=True)
-                
-                # transition to dormancy
-                lambda_ = df_a['resource quota']/df_a['basal metabolic rate']
-                p = 1/(1+lambda_) * df_a['age']/(10+df_a['age'])
-                df_a['metabolic state'] = 1 - np.random.binomial(1, p, size = df_a.shape[0])
-                df_a['symbol'] = ['circle']*df_a.shape[0]
-            
-        ####################################################
-        #### SIMULATE PROCESS AMONG DORMANT INDIVIDUALS ####
-        ####################################################
-        
-        df_d = individuals[individuals['metabolic state'] == 0]
-        n = df_d.shape[0]
-        if n > 0:
-        
-            # dormant maintenance
-            df_d['resource quota'] = df_d['resource quota'] - df_d['basal metabolic rate'] * df_d['bmr reduction in dormancy']
-            
-            df_d['resource quota'] = df_d['resource quota'].apply(lambda x : x if x > 0 else 0)
-            df_d['resource quota'].fillna(0, inplace=True)
-            
-            # death
-            if death_toggle == ' on':
-                df_d = df_d[df_d['resource quota'] >= 0]
-                df_d['symbol'] = ['circle-open']*df_d.shape[0]
-            
-            if df_d.shape[0] > 0:
-                # transition to activity
-                df_d['metabolic state'] = np.random.binomial(1, df_d['resuscitation rate'], size = df_d.shape[0])
-                
-                # increase age
-                df_d['age'] = df_d['age'] + 1
-                
-                # outflow of individuals
-                df_d = df_d[df_d['x_coord'] <= w]
-        
-    
-        if df_a.shape[0] > 0 and df_d.shape[0] > 0:
-            df = pd.concat([df_a, df_d], ignore_index=True)
-        elif df_a.shape[0] > 0:
-            df = df_a.copy(deep=True)
-        elif df_d.shape[0] > 0:
-            df = df_d.copy(deep=True)
-        else:
-            df = None
-          
-    if isinstance(df, list) == True:
-        df = None
-
-    ########### SIMULATE RESOURCE FLOW ##############
-    if resources.shape[0] > 0:
-        resources['x_coord'] = resources['x_coord'] + (Q*0.01)*w
-        resources = resources[resources['x_coord'] <= w]
+    tick, Nc, S, R = 0, 0, 0, 0
+    if frame is not None:
+        tick = frame.tick
+        Nc, S, R = frame.summary
     
-    ####################################################
-    ############### CHECK DATAFRAMES ###################
-    ####################################################
+    Nc_S_R = 'N = ' + str(Nc) + ' | ' + 'S = ' + str(S) + ' | ' + 'Total resources = ' + str(np.round(R, 3))
     
-    if resources.shape[0] == 0:
-        resources = None
-        
-    if df is None and resources is None:
-        Nc_S_R = 'N = 0' + ' | S = 0' + ' | Total resources = 0'
-        N1.append(0)
-        S1.append(0)
-        R1.append(0)
-        return figure, df, species.to_json(), resources, Nc_S_R, N1, S1, R1, max_n + 1, 0
-        
-    elif df is None:
-        R = np.sum(resources['size'])
-        Nc_S_R = 'N = 0' + ' | ' + 'S = 0' + ' | ' + 'Total resources = ' + str(np.round(R,3))
-        N1.append(0)
-        S1.append(0)
-        R1.append(R)
-        return figure, df, species.to_json(), resources.to_json(), Nc_S_R, N1, S1, R1, max_n + 1, 0
+    # stream new time series points into the time series figure; after a reset, or in a
+    # new session, the figure is redrawn in full instead. Epochs of different sessions
+    # both start at 0, so the store holds the session ID with the epoch
+    extend = dash.no_update
+    epoch = [sid, epoch]
+    new_epoch = epoch != last_epoch
+    if new_epoch:
+        last_epoch = epoch
+    else:
+        last_epoch = dash.no_update
+        col = SERIES_VARIABLES.get(series_var)
+        if col is not None and rows.shape[0] > 0:
+            extend = [dict(x=[rows[:, 0]], y=[rows[:, col]]), [0], HISTORY_LENGTH]
     
-    ####################################################
-    ################ GENERATE FIGURE ###################
-    ####################################################
+    # poll again when the next frame is due: the worker publishes one every frame budget,
+    # or less often when its steps are slow
+    period = session.worker.frame_period() if session.worker is not None else FRAME_BUDGET
+    interval = 1e3*period - 1e3*(time.time() - start)
+    interval = int(min(MAX_INTERVAL, max(MIN_INTERVAL, interval)))
     
-    if df.shape[0] > 0:
-        if df.shape[0] > 1000 and n_clicks4 > 0:
-            df = df.sample(n=1000, replace=False)
-            
-        fig_data = []
-        fig_data.append(go.Scatter(
-                            x = df['x_coord'],
-                            y = df['y_coord'],
-                            text = 'Body size: ' + np.round(df['body size'], 3).astype(str) + '<br>' + 'Resource quota: ' + np.round(df['resource quota'], 3).astype(str) + '<br>' + 'BMR: ' + np.round(df['basal metabolic rate'], 3).astype(str) + '<br>' + 'BMR reduction in dormancy: ' + np.round(df['bmr reduction in dormancy'], 3).astype(str) + '<br>' + 'Resource use efficiency: ' + np.round(df['resource efficiency 1'], 3).astype(str) + '<br>' + 'Resuscitation rate: ' + np.round(df['resuscitation rate'], 3).astype(str) + '<br>' + 'Active dispersal rate: ' + np.round(df['active dispersal rate'], 3).astype(str) + '<br>' + 'Growth rate: ' + np.round(df['growth rate'], 3).astype(str),
-                            mode = "markers",
-                            marker_size= 4 + df[plot_by]**0.75,
-                            marker_color=df['color'],
-                            marker_symbol=df['symbol'],
-                            
-                        )
-                    )
-                        
-        figure = go.Figure(
-                data = fig_data,
-                layout = go.Layout(
-                    xaxis = dict(
-                        title = dict(
-                            text = None,
-                            font = dict(
-                                family = '"Open Sans", "HelveticaNeue", "Helvetica Neue",'
-                                " Helvetica, Arial, sans-serif",
-                                size = 18,
-                            ),
-                        ),
-                        rangemode="tozero",
-                        zeroline=True,
-                        showticklabels = False,
-                    ),
-                                    
-                    yaxis = dict(
-                        title = dict(
-                            text = None,
-                            font = dict(
-                                family = '"Open Sans", "HelveticaNeue", "Helvetica Neue",'
-                                " Helvetica, Arial, sans-serif",
-                                size = 18,
-                            ),
-                        ),
-                        rangemode="tozero",
-                        zeroline=True,
-                        showticklabels = False,
-                    ),
-                                    
-                    margin = dict(l=0, r=0, b=0, t=0),
-                    showlegend = False,
-                    height = 500,
-                    paper_bgcolor = "rgb(245, 247, 249)",
-                    plot_bgcolor = "rgb(245, 247, 249)",
-                ),
+    # only a new frame, or the first of a new epoch, changes the tick, which triggers
+    # draw_frame
+    tick = tick if tick != last_tick or new_epoch else dash.no_update
+    return tick, Nc_S_R, get_rate_text(session), extend, last_epoch, interval, next_tick
+
+
+
+@app.callback(Output('frame', 'data'),
+              [Input('tick', 'data'),
+               Input('plot_by', 'value'),
+               Input('hover_mode', 'value')],
+              [State('session_id', 'data')],
+              prevent_initial_call=True,
             )
-        
-        figure.update_xaxes(range=[0, w])
-        figure.update_yaxes(range=[0, h])
-        
-        Nc = str(df.shape[0])
-        S = str(len(list(set(df['Species ID'].tolist()))))
-        R = str(np.round(np.sum(resources['size']), 3))
-        
-    Nc_S_R = 'N = ' + Nc + ' | ' + 'S = ' + S + ' | ' + 'Total resources = ' + R
-    
-    if N1 is None:
-        N1 = []
-    N1.append(float(Nc))
+def draw_frame(tick, plot_by, hover_mode, sid):
+    # packs the frame last fetched by run_model, which is drawn in the browser by
+    # render_frame in assets/resizing.js; changing how individuals are shown redraws that
+    # frame without stepping the model
+    session = SESSIONS.get(sid)
+    if session is None:
+        raise PreventUpdate
+    METRICS.count('draw_frame', sid)
     
-    if S1 is None:
-        S1 = []
-    S1.append(float(S))
+    frame = session.shown
+    if frame is None or frame.state.n == 0:
+        return dict(tick = 0, n = 0)
+    with METRICS.timer('frame_payload', sid, frame.state.n):
+        return get_frame_payload(frame.state, frame.tick, plot_by,
+                                 inspect = hover_mode == ' click to inspect')
     
-    if R1 is None:
-        R1 = []
-    R1.append(float(R))
     
-    if resources is None:
-        return figure, df.to_json(), species.to_json(), resources, Nc_S_R, N1, S1, R1, max_n + 1, 0
-        
-    return figure, df.to_json(), species.to_json(), resources.to_json(), Nc_S_R, N1, S1, R1, max_n + 1, 0
     
     
+
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='render_frame'),
+    Output('model_animation_fig', 'figure'),
+    [Input('frame', 'data')],
+    [State('model_animation_fig', 'figure')],
+)
+
+
+@app.callback(Output('inspect_text', 'children'),
+              [Input('model_animation_fig', 'clickData'),
+               Input('hover_mode', 'value')],
+              [State('session_id', 'data')],
+            )
+def inspect_individual(click_data, hover_mode, sid):
+    # details of one individual are only fetched when it is clicked in inspect mode
+    if hover_mode != ' click to inspect' or not click_data:
+        return ''
     
+    session = SESSIONS.get(sid)
+    if session is None:
+        raise PreventUpdate
     
+    # the clicked point is one of the frame on screen, which is a copy the worker never
+    # touches, so it is looked up there without waiting for a step
+    frame = session.shown
+    if frame is None:
+        return ''
+    ind_id = int(click_data['points'][0]['customdata'][0])
+    return get_inspect_text(frame.state, ind_id)
+
 
 @app.callback(Output('time_series_fig', 'figure'),
-             [Input('btn4', 'n_clicks')],
-             [State('plot_by2', 'value'),
-              State('N_ls', 'children'),
-              State('S_ls', 'children'),
-              State('R_ls', 'children')],
+             [Input('btn4', 'n_clicks'),
+              Input('plot_by2', 'value'),
+              Input('series_epoch', 'data')],
+             [State('session_id', 'data'),
+              State('tick', 'data')],
               )
-def time_series_plot(n_clicks, var_lab, N, S, R):
-    x = []
+@METRICS.timed('time_series_plot', sid_arg=3)
+def time_series_plot(n_clicks, var_lab, epoch, sid, last_tick):
+    # draws the series up to the last frame shown; later points are streamed in by run_model
+    t, x = [], []
     
-    if var_lab == 'Total abundance (N)':
-        if N is None:
-            x = []
-        else:
-            x = list(N)
-    elif var_lab == 'Species richness (S)':
-        if S is None:
-            x = []
-        else:
-            x = list(S)
-    elif var_lab == 'Total resources':
-        if R is None:
-            x = []
-        else:
-            x = list(R)
+    session = SESSIONS.get(sid)
+    col = SERIES_VARIABLES.get(var_lab)
+    if session is not None and col is not None:
+        rows = session.series_rows(until=last_tick)
+        t, x = rows[:, 0], rows[:, col]
 
     fig_data = []
     fig_data.append(go.Scatter(
-                        x = list(range(len(x))),
+                        x = t,
                         y = x,
                         mode='lines+markers',
                         marker_size= 10,
@@ -1183,18 +1517,21 @@ def time_series_plot(n_clicks, var_lab, N, S, R):
 @app.callback(Output('distribution_fig', 'figure'),
             [Input('btn5', 'n_clicks')],
             [State('plot_by3', 'value'),
-             State('main_df', 'data'),
+             State('kde_bandwidth', 'value'),
+             State('session_id', 'data'),
             ],
             )
-def distribution_plot(n_clicks, var_lab, main_df):
+@METRICS.timed('distribution_plot', sid_arg=3)
+def distribution_plot(n_clicks, var_lab, kernel, sid):
         x = []
         
-        if main_df is None:
+        density = None
+        if var_lab is not None:
+            density = get_session_density(sid, var_lab, kernel)
+        if density is None:
             x, y = [0]*100, [0]*100
         else:
-            main_df = pd.read_json(main_df)
-            x = main_df[var_lab].dropna()
-            x, y = get_kdens_choose_kernel(x, 0.5)
+            x, y = density
             
         fig_data = []
         fig_data.append(go.Scatter(
@@ -1252,26 +1589,23 @@ def distribution_plot(n_clicks, var_lab, main_df):
 
 
 
-@app.callback(Output('xy_fig', 'figure'),
-            [Input('btn6', 'n_clicks')],
-            [State('plot_by4', 'value'),
-             State('plot_by5', 'value'),
-             State('main_df', 'data'),
-            ],
-            )
-def distribution_plot(n_clicks, x_var, y_var, main_df):
+@METRICS.timed('xy_plot', sid_arg=3)
+def get_xy_figure(x_var, y_var, model, sid):
+        """ Scatter of two variables of the latest frame of a session, with the fit of
+            `model` if one is chosen. Kept apart from its callback so it can also be
+            called directly, e.g. by benchmark.py """
         x = []
+        fit = None
         
-        if main_df is None:
+        xy = None
+        if x_var is not None and y_var is not None:
+            xy = get_session_xy(sid, x_var, y_var)
+        if xy is None:
             x, y = [0]*100, [0]*100
         else:
-            main_df = pd.read_json(main_df)
-            tdf = main_df.filter(items=[x_var, y_var], axis=1)
-            del main_df
-            
-            tdf.dropna(inplace=True)
-            x = tdf[x_var]
-            y = tdf[y_var]
+            x, y, fit_stats = xy
+            if model is not None:
+                fit = fit_stats.fit(model)
             
             
         fig_data = []
@@ -1284,6 +1618,23 @@ def distribution_plot(n_clicks, x_var, y_var, main_df):
                                 marker_symbol='circle',
                             )
                         )
+        
+        annotations = []
+        if fit is not None:
+            coefs, r2 = fit
+            fx, fy = get_fit_curve(model, coefs, fit_stats.x_range)
+            fig_data.append(go.Scatter(
+                                x = fx,
+                                y = fy,
+                                mode='lines',
+                                line_color='#ff7f0e',
+                                line_width=3,
+                            )
+                        )
+            annotations.append(dict(text = get_fit_text(model, coefs, r2),
+                                    xref = 'paper', yref = 'paper', x = 0.01, y = 0.99,
+                                    xanchor = 'left', yanchor = 'top', showarrow = False,
+                                    font = dict(size = 14)))
                             
         figure = go.Figure(
                     data = fig_data,
@@ -1320,6 +1671,7 @@ def distribution_plot(n_clicks, x_var, y_var, main_df):
                                         
                         margin = dict(l=0, r=0, b=0, t=0),
                         showlegend = False,
+                        annotations = annotations,
                         height = 440,
                         paper_bgcolor = "rgb(245, 247, 249)",
                         plot_bgcolor = "rgb(245, 247, 249)",
@@ -1327,6 +1679,80 @@ def distribution_plot(n_clicks, x_var, y_var, main_df):
                 )
             
         return figure
+
+
+
+@app.callback(Output('xy_fig', 'figure'),
+            [Input('btn6', 'n_clicks')],
+            [State('plot_by4', 'value'),
+             State('plot_by5', 'value'),
+             State('model', 'value'),
+             State('session_id', 'data'),
+            ],
+            )
+def distribution_plot(n_clicks, x_var, y_var, model, sid):
+        return get_xy_figure(x_var, y_var, model, sid)
+
+
+# timed phases in the order they happen for a frame; other phases are listed after these
+PHASES = ['step', 'publish', 'fetch', 'frame_payload', 'time_series_plot', 'kde',
+          'distribution_plot', 'fit_stats', 'xy_plot']
+
+
+@app.callback(Output('performance_fig', 'figure'),
+            [Input('metrics_interval', 'n_intervals')],
+            [State('session_id', 'data')],
+            )
+def performance_plot(n_intervals, sid):
+        timings = METRICS.session(sid) if sid is not None else {}
+        calls = METRICS.calls(sid) if sid is not None else {}
+        phases = [p for p in PHASES if p in timings] + sorted(set(timings) - set(PHASES))
+        
+        N = None
+        for p in phases:
+            if timings[p][3] is not None:
+                N = timings[p][3]
+        
+        # phases are listed top to bottom, so the bars are drawn in reverse
+        fig_data = [go.Bar(
+                        x = [1e3*timings[p][0] for p in phases][::-1],
+                        y = phases[::-1],
+                        orientation = 'h',
+                        marker_color = '#99ccff',
+                        text = ['%.1f ms (last %.1f, n = %d)' % (1e3*timings[p][0], 1e3*timings[p][1], timings[p][2])
+                                for p in phases][::-1],
+                        textposition = 'auto',
+                        hoverinfo = 'text',
+                    )]
+        
+        figure = go.Figure(
+                    data = fig_data,
+                    layout = go.Layout(
+                        xaxis = dict(
+                            title = dict(
+                                text = 'Moving average time (ms)',
+                                font = dict(
+                                    family = '"Open Sans", "HelveticaNeue", "Helvetica Neue",'
+                                    " Helvetica, Arial, sans-serif",
+                                    size = 18,
+                                ),
+                            ),
+                            rangemode="tozero",
+                            visible=True,
+                            showticklabels = True,
+                        ),
+                        yaxis = dict(automargin = True),
+                        margin = dict(l=0, r=0, b=0, t=30),
+                        title = dict(text = get_calls_text(N, calls), x = 0.5,
+                                     font = dict(size = 14)),
+                        showlegend = False,
+                        height = 440,
+                        paper_bgcolor = "rgb(245, 247, 249)",
+                        plot_bgcolor = "rgb(245, 247, 249)",
+                    ),
+                )
+        
+        return figure
         
 #########################################################################################
 ############################# Run the server ############################################
@@ -1,10 +1,71 @@
 /* resize figures in table upon callback get fires */
 
 if(!window.dash_clientside) {window.dash_clientside = {};}
+
+/* decode a base64 string of little-endian values into a typed array */
+function decode_array(b64, type) {
+    var bin = atob(b64);
+    var bytes = new Uint8Array(bin.length);
+    for (var i = 0; i < bin.length; i++) {
+        bytes[i] = bin.charCodeAt(i);
+    }
+    return new type(bytes.buffer);
+}
+
+var SYMBOLS = ['circle-open', 'circle'];
+
 window.dash_clientside.clientside = {
    resize: function (value) {
        console.log("resizing...");
        window.dispatchEvent(new Event('resize'));
        return null
+   },
+
+   /* draw a frame packed by get_frame_payload in app.py into the IBM animation */
+   render_frame: function (frame, figure) {
+       if (!frame) {
+           return window.dash_clientside.no_update;
+       }
+       var layout = Object.assign({}, figure.layout);
+       var visible = frame.n > 0;
+       layout.xaxis = Object.assign({}, layout.xaxis, {visible: visible});
+       layout.yaxis = Object.assign({}, layout.yaxis, {visible: visible});
+       if (!visible) {
+           return {data: [], layout: layout};
+       }
+
+       var sp = decode_array(frame.sp, Uint32Array);
+       var codes = decode_array(frame.symbol, Uint8Array);
+       var palette = Array.from(decode_array(frame.palette, Uint32Array),
+                                function (id) {return '#' + id.toString(16).padStart(6, '0');});
+       var ind = decode_array(frame.ind_id, Uint32Array);
+       var hover = frame.hover.map(function (b64) {return decode_array(b64, Float32Array);});
+       var traits = frame.hover_traits.map(function (b64) {return decode_array(b64, Float32Array);});
+       var colors = new Array(frame.n);
+       var symbols = new Array(frame.n);
+       var customdata = new Array(frame.n);
+       for (var i = 0; i < frame.n; i++) {
+           colors[i] = palette[sp[i]];
+           symbols[i] = SYMBOLS[codes[i]];
+           var row = [ind[i]];
+           for (var j = 0; j < hover.length; j++) {row.push(hover[j][i]);}
+           for (var j = 0; j < traits.length; j++) {row.push(traits[j][sp[i]]);}
+           customdata[i] = row;
+       }
+
+       var trace = {
+           type: frame.gl ? 'scattergl' : 'scatter',
+           mode: 'markers',
+           x: decode_array(frame.x, Float32Array),
+           y: decode_array(frame.y, Float32Array),
+           customdata: customdata,
+           hovertemplate: frame.hovertemplate,
+           marker: {
+               size: decode_array(frame.size, Float32Array),
+               color: colors,
+               symbol: symbols
+           }
+       };
+       return {data: [trace], layout: layout};
    }
-}
\ No newline at end of file
+}
@@ -0,0 +1,145 @@
+""" Headless batch runner for the IBM.
+
+Runs replicate IBMs over every combination of the given parameter values without the
+Dash app, spreading replicates across a process pool. With --batch B, each process steps
+B replicates of a parameter set together as one batched state, which removes most of the
+per-replicate overhead for small communities. Each replicate is written to its own
+compressed .npz file of columnar arrays:
+
+    N, S, R                 total abundance, species richness and total resources per tick
+    species, x_coord, y_coord, resource_quota, body_size, age, metabolic_state, weight
+                            the final population; species is a row of the species pool,
+                            weight the individuals each agent stands for (see --max-agents)
+    sp_ids, sp_traits       the species pool
+    params                  JSON string of the parameters, number of ticks, seed and
+                            position of the replicate in its batch
+
+Example:
+
+    python batch.py --ticks 1000 --replicates 100 --Q 1 5 10 --death on off --out runs
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from ibm import IBMState, advance, TRAITS, DEFAULT_PARAMS
+
+#########################################################################################
+################################# REPLICATE RUNS ########################################
+#########################################################################################
+
+def run_replicates(job):
+    """ Runs a batch of replicates of one parameter set together and writes each to disk.
+        Returns the path and final N, S and R of every replicate """
+    params, ticks, seed, paths, dtype, jit = job
+    state = IBMState.new(params['S'], seed=seed, replicates=len(paths), dtype=dtype)
+    # the agent budget is per replicate, and merging acts on the whole batch
+    model_params = dict(params, max_agents=params['max_agents']*len(paths))
+    history = np.array(advance(state, model_params, ticks, jit=jit), dtype=np.float64)
+    history = history.reshape(ticks, 3, len(paths))
+    S = state.n_species
+
+    rep = state.rep
+    results = []
+    for r, path in enumerate(paths):
+        i = rep == r
+        np.savez_compressed(path,
+                            N = history[:, 0, r].astype(np.int64),
+                            S = history[:, 1, r].astype(np.int64),
+                            R = history[:, 2, r],
+                            species = state.sp[i] - r*S,
+                            x_coord = state.x[i],
+                            y_coord = state.y[i],
+                            resource_quota = state.quota[i],
+                            body_size = state.size[i],
+                            age = state.age[i],
+                            metabolic_state = state.state[i],
+                            weight = state.weight[i],
+                            trait_names = np.array(TRAITS),
+                            sp_ids = state.sp_ids[r*S:(r + 1)*S],
+                            sp_traits = state.sp_traits[r*S:(r + 1)*S],
+                            params = np.array(json.dumps(dict(params, ticks=ticks, seed=seed,
+                                                              batch_index=r))))
+        results.append((path, tuple(history[-1, :, r])))
+    return results
+
+
+def make_jobs(grid, replicates, ticks, seed, out, batch=1, dtype=np.float64, jit=False):
+    """ Returns one job per batch of replicates of every parameter combination in grid """
+    names = sorted(grid)
+    combos = list(itertools.product(*[grid[k] for k in names]))
+    n_batches = -(-replicates // batch)
+    seeds = np.random.SeedSequence(seed).generate_state(len(combos) * n_batches)
+
+    jobs = []
+    for i, values in enumerate(combos):
+        params = dict(DEFAULT_PARAMS)
+        params.update(zip(names, values))
+        for b in range(n_batches):
+            paths = [os.path.join(out, 'set%04d_rep%04d.npz' % (i, r))
+                     for r in range(b*batch, min((b + 1)*batch, replicates))]
+            jobs.append((params, ticks, int(seeds[i*n_batches + b]), paths, dtype, jit))
+    return jobs
+
+#########################################################################################
+################################# COMMAND LINE ##########################################
+#########################################################################################
+
+def on_off(value):
+    if value not in ('on', 'off'):
+        raise argparse.ArgumentTypeError("expected 'on' or 'off'")
+    return value == 'on'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ticks', type=int, default=1000, help='time steps per replicate')
+    parser.add_argument('--replicates', type=int, default=10, help='replicates per parameter set')
+    parser.add_argument('--S', type=int, nargs='+', default=[DEFAULT_PARAMS['S']], help='number of species')
+    parser.add_argument('--Q', type=float, nargs='+', default=[DEFAULT_PARAMS['Q']], help='flow rate')
+    parser.add_argument('--R', type=float, nargs='+', default=[DEFAULT_PARAMS['R0']], help='resource inflow')
+    parser.add_argument('--immigration', type=float, nargs='+', default=[DEFAULT_PARAMS['immigration']], help='immigration rate')
+    for flag, toggle in [('--immigration_on', 'immigration_on'), ('--reproduction', 'reproduction_on'),
+                         ('--death', 'death_on'), ('--dispersal', 'dispersal_on')]:
+        parser.add_argument(flag, dest=toggle, type=on_off, nargs='+', default=[True],
+                            metavar='on|off', help='turn a process on or off')
+    parser.add_argument('--radius', type=float, nargs='+', default=[DEFAULT_PARAMS['consumption_radius']],
+                        help='consumption radius (0: resources are pooled across the system)')
+    parser.add_argument('--max-agents', dest='max_agents', type=int, nargs='+',
+                        default=[DEFAULT_PARAMS['max_agents']],
+                        help='agents per replicate beyond which individuals merge into super-individuals (0: off)')
+    parser.add_argument('--batch', type=int, default=1, help='replicates stepped together per process task')
+    parser.add_argument('--float32', action='store_true', help='store continuous attributes as float32')
+    parser.add_argument('--jit', action='store_true',
+                        help='run each time step as one Numba-compiled pass (NumPy if Numba is not installed)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the replicate seeds')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--out', default='runs', help='output directory')
+    args = parser.parse_args(argv)
+
+    grid = dict(S = args.S, Q = args.Q, R0 = args.R, immigration = args.immigration,
+                immigration_on = args.immigration_on, reproduction_on = args.reproduction_on,
+                death_on = args.death_on, dispersal_on = args.dispersal_on,
+                consumption_radius = args.radius, max_agents = args.max_agents)
+
+    os.makedirs(args.out, exist_ok=True)
+    jobs = make_jobs(grid, args.replicates, args.ticks, args.seed, args.out, max(1, args.batch),
+                     np.float32 if args.float32 else np.float64, args.jit)
+
+    start = time.time()
+    n = 0
+    with multiprocessing.Pool(args.processes) as pool:
+        for results in pool.imap_unordered(run_replicates, jobs):
+            for path, (N, S, R) in results:
+                print('%s  N = %d | S = %d | Total resources = %.3f' % (path, N, S, R))
+                n += 1
+    print('%d replicates in %.1f s' % (n, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+""" Benchmarks for the IBM engine and the app.
+
+Times the stages that turn a community into what the browser shows, on seeded
+populations of several sizes: the model step (NumPy and, if Numba is installed, the fused
+kernel), publishing a frame, packing and JSON-serializing the animation frame, the
+DataFrame JSON round trip of the original stores, building a Plotly figure, the kernel
+density estimate and the xy panel callback. Also compares the memory and step time of
+the default float64 state and the opt-in float32 state, and the payload size and encode and
+decode times of the store codecs (see codec.py). Results can be written to a JSON
+file to compare runs:
+
+    python benchmark.py
+    python benchmark.py --sizes 1000 100000 --repeats 20 --json bench.json
+"""
+import argparse
+import io
+import json
+import platform
+import time
+
+import numpy as np
+import pandas as pd
+
+from ibm import IBMState, step, HAVE_NUMBA, W, H, DEFAULT_PARAMS
+from codec import CODECS, encode_state, decode_state
+
+SIZES = [1000, 5000, 10000, 50000, 100000]
+
+#########################################################################################
+################################# SEEDED POPULATIONS ####################################
+#########################################################################################
+
+def make_population(N, S=100, seed=0, dtype=np.float64):
+    """ Returns a state with N individuals of S species spread through the system, with
+        random sizes, quotas, ages and metabolic states, and a full set of resource parcels """
+    state = IBMState.new(S, seed=seed, dtype=dtype)
+    rng = state.rng
+    state.clear()
+    state.add_individuals(rng.integers(0, S, size=N), rng.uniform(0, H, size=N))
+    state.x[:] = rng.uniform(0, W, size=N)
+    state.quota[:] = rng.uniform(0, 20, size=N)
+    state.size[:] = rng.uniform(1, 40, size=N)
+    state.age[:] = rng.integers(0, 50, size=N)
+    state.state[:] = rng.integers(0, 2, size=N)
+
+    n_res = int(W / (DEFAULT_PARAMS['Q']*0.01*W))
+    state.set_resources(np.zeros(n_res, dtype=np.int64), np.linspace(0, W, n_res),
+                        rng.uniform(0, H, size=n_res), np.full(n_res, float(DEFAULT_PARAMS['R0'])))
+    return state
+
+
+def time_call(f, repeats, setup=None):
+    """ Median time of f(setup()) (or f()) over repeated calls; setup is not timed """
+    times = []
+    for r in range(repeats):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        f(*args)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def time_step(state, repeats, jit=False):
+    """ Median time of one step, each taken from a fresh copy of state """
+    p = DEFAULT_PARAMS
+    return time_call(lambda s: step(s, p['Q'], p['R0'], immigration=p['immigration'], jit=jit),
+                     repeats, state.copy)
+
+#########################################################################################
+################################# BENCHMARKS ############################################
+#########################################################################################
+
+def bench_dtypes(sizes, repeats):
+    """ Memory per individual and step time of float64 and float32 states """
+    results = []
+    print('%10s %8s %12s %10s %12s' % ('N', 'dtype', 'bytes/ind', 'MB', 'step (ms)'))
+    for N in sizes:
+        for dtype in (np.float64, np.float32):
+            state = make_population(N, dtype=dtype)
+            nbytes = state.nbytes()
+            ms = 1e3*time_step(state, repeats)
+            print('%10d %8s %12.1f %10.2f %12.2f' % (N, np.dtype(dtype).name, nbytes/N,
+                                                    nbytes/1e6, ms))
+            results.append(dict(stage = 'step', N = N, dtype = np.dtype(dtype).name,
+                                ms = ms, bytes_per_individual = nbytes/N))
+    return results
+
+
+def bench_codecs(sizes, repeats):
+    """ Payload size and encode and decode times (including the JSON a dcc.Store adds) of
+        every codec """
+    results = []
+    print('%10s %8s %12s %12s %12s' % ('N', 'codec', 'KB', 'encode (ms)', 'decode (ms)'))
+    for N in sizes:
+        state = make_population(N)
+        for codec in CODECS:
+            text = json.dumps(encode_state(state, codec))
+            encode = 1e3*time_call(lambda: json.dumps(encode_state(state, codec)), repeats)
+            decode = 1e3*time_call(lambda: decode_state(json.loads(text)), repeats)
+            print('%10d %8s %12.1f %12.2f %12.2f' % (N, codec, len(text)/1024, encode, decode))
+            results.append(dict(stage = 'codec', N = N, codec = codec, bytes = len(text),
+                                encode_ms = encode, decode_ms = decode))
+    return results
+
+
+def app_stages(state):
+    """ Returns (name, function, setup) for every timed stage of producing a frame in the
+        app from a state. The app is only imported here, so the engine benchmarks run
+        without Dash installed """
+    import plotly.graph_objects as go
+    import app
+
+    sid = app.SESSIONS.create()
+    session = app.SESSIONS.get(sid)
+    session.state = state
+    session.publish()
+    payload = app.get_frame_payload(state, 1, 'body size')
+    df_json = state.individuals_frame().to_json(orient='split')
+
+    def xy_callback():
+        # fits are memoized per tick, so clear them to time the full callback
+        app.FIT_CACHE.clear()
+        app.get_xy_figure('body size', 'resource quota', 'Cubic', sid)
+
+    return [('publish', session.publish, None),
+            ('frame_payload', lambda: app.get_frame_payload(state, 1, 'body size'), None),
+            ('payload_json', lambda: json.loads(json.dumps(payload)), None),
+            ('dataframe_to_json', lambda: state.individuals_frame().to_json(orient='split'), None),
+            ('dataframe_read_json', lambda: pd.read_json(io.StringIO(df_json), orient='split'), None),
+            ('figure', lambda: go.Figure(data=[go.Scatter(x=state.x, y=state.y, mode='markers')]), None),
+            ('kde', lambda: app.get_kdens_choose_kernel(state.size), None),
+            ('xy_callback', xy_callback, None)], lambda: app.SESSIONS.drop(sid)
+
+
+def bench_stages(sizes, repeats, with_app=True):
+    """ Times the model step and, with_app, every stage of producing a frame in the app """
+    results = []
+    print('%-22s %10s %12s' % ('stage', 'N', 'time (ms)'))
+    for N in sizes:
+        state = make_population(N)
+        stages = [('step', lambda s: step(s, DEFAULT_PARAMS['Q'], DEFAULT_PARAMS['R0'],
+                                           immigration=DEFAULT_PARAMS['immigration']), state.copy)]
+        if HAVE_NUMBA:
+            time_step(state, 1, jit=True) # compile outside the timings
+            stages.append(('step_jit', lambda s: step(s, DEFAULT_PARAMS['Q'], DEFAULT_PARAMS['R0'],
+                                                      immigration=DEFAULT_PARAMS['immigration'],
+                                                      jit=True), state.copy))
+        cleanup = None
+        if with_app:
+            more, cleanup = app_stages(state)
+            stages += more
+
+        for name, f, setup in stages:
+            ms = 1e3*time_call(f, repeats, setup)
+            print('%-22s %10d %12.2f' % (name, N, ms))
+            results.append(dict(stage = name, N = N, dtype = state.dtype.name, ms = ms))
+        if cleanup is not None:
+            cleanup()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='population sizes')
+    parser.add_argument('--repeats', type=int, default=10, help='timed calls per measurement')
+    parser.add_argument('--no-app', dest='app', action='store_false',
+                        help='only benchmark the model, without importing the app')
+    parser.add_argument('--json', default=None, help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = bench_stages(args.sizes, args.repeats, args.app)
+    print()
+    results += bench_dtypes(args.sizes, args.repeats)
+    print()
+    results += bench_codecs(args.sizes, args.repeats)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(dict(time = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           python = platform.python_version(),
+                           numpy = np.__version__,
+                           numba = HAVE_NUMBA,
+                           repeats = args.repeats,
+                           results = results), f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
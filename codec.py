@@ -0,0 +1,98 @@
+""" Compact transport of IBM states for deployments that keep them in the browser.
+
+A state is encoded by a codec into a JSON-safe dict that a dcc.Store can hold, and decoded
+back into an IBMState:
+
+    json      the species, individuals and resources DataFrames as pandas' column-oriented
+              JSON, as the original stores held them
+    binary    the arrays of IBMState.to_arrays packed into one buffer with an explicit
+              schema of names, dtypes and shapes, zlib-compressed and base64-encoded
+
+Decoding a binary payload infers no types: every array is a view of the decompressed
+buffer, and only the copy into the new state's buffers remains. Binary payloads also keep
+the state of the RNG, so a decoded state continues exactly like a checkpoint. Further
+codecs can be added to CODECS as (encode, decode) pairs.
+
+    payload = encode_state(state)
+    state = decode_state(payload)
+"""
+import base64
+import io
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from ibm import IBMState
+
+ALIGN = 8 # arrays start at multiples of this many bytes of the packed buffer
+
+ZLIB_LEVEL = 1 # fast compression; the arrays gain little from higher levels
+
+
+def encode_columns(columns, level=ZLIB_LEVEL):
+    """ Packs a dict of arrays into {'schema': [[name, dtype, shape], ...], 'data': str},
+        where data is the base64 of the zlib-compressed little-endian buffers """
+    schema = []
+    chunks = []
+    for name, a in columns.items():
+        a = np.asarray(a)
+        if a.dtype.byteorder == '>':
+            a = a.astype(a.dtype.newbyteorder('<'))
+        schema.append([name, a.dtype.str, list(a.shape)])
+        b = a.tobytes()
+        chunks.append(b + bytes(-len(b) % ALIGN))
+    data = zlib.compress(b''.join(chunks), level)
+    return dict(schema = schema, data = base64.b64encode(data).decode('ascii'))
+
+
+def decode_columns(payload):
+    """ Unpacks the arrays of encode_columns as read-only views of one buffer """
+    buf = zlib.decompress(base64.b64decode(payload['data']))
+    columns = {}
+    offset = 0
+    for name, dtype, shape in payload['schema']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        columns[name] = np.frombuffer(buf, dtype, count, offset).reshape(shape)
+        offset += count*dtype.itemsize
+        offset += -offset % ALIGN
+    return columns
+
+#########################################################################################
+################################# CODECS ################################################
+#########################################################################################
+
+def encode_binary(state):
+    return encode_columns(state.to_arrays())
+
+
+def decode_binary(payload):
+    return IBMState.from_arrays(decode_columns(payload))
+
+
+def encode_json(state):
+    return dict(species = state.species_frame().to_json(orient='split'),
+                individuals = state.individuals_frame().to_json(orient='split'),
+                resources = state.resources_frame().to_json(orient='split'))
+
+
+def decode_json(payload):
+    read = lambda k: pd.read_json(io.StringIO(payload[k]), orient='split')
+    return IBMState.from_frames(read('species'), read('individuals'), read('resources'))
+
+
+CODECS = dict(binary = (encode_binary, decode_binary),
+              json = (encode_json, decode_json))
+
+
+def encode_state(state, codec='binary'):
+    """ Encodes a state with one of CODECS. The payload names its codec """
+    payload = CODECS[codec][0](state)
+    payload['codec'] = codec
+    return payload
+
+
+def decode_state(payload):
+    """ Decodes a payload of encode_state with the codec it names """
+    return CODECS[payload['codec']][1](payload)
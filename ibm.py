@@ -0,0 +1,1131 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+#########################################################################################
+################################# MODEL CONSTANTS #######################################
+#########################################################################################
+
+W = 100 # length of the system (x-axis)
+H = 50  # height of the system (y-axis)
+
+TRAITS = ['growth rate', 'active dispersal rate', 'resuscitation rate', 'basal metabolic rate',
+          'bmr reduction in dormancy', 'immigration rate', 'resource efficiency 1']
+
+# column positions of each trait in the trait matrices
+T_GROWTH, T_DISP, T_RESUSC, T_BMR, T_BMR_RED, T_IMM, T_EFF = range(len(TRAITS))
+
+# marker symbols, indexed by the uint8 symbol code of an individual
+SYMBOLS = np.array(['circle-open', 'circle'], dtype=object)
+OPEN, FILLED = 0, 1
+
+# bins per dimension of the successively coarser grids on which super-individuals merge
+MERGE_BINS = [16, 8, 4, 2, 1]
+
+COMPACT_BLOCK = 65536 # rows moved at a time when IBMState.select compacts the buffers
+
+# bit generators a saved RNG may name; checkpoints are uploaded, so no other attribute of
+# np.random is ever called
+BIT_GENERATORS = {name: getattr(np.random, name)
+                  for name in ['PCG64', 'PCG64DXSM', 'Philox', 'SFC64', 'MT19937']}
+
+# model parameters, with the defaults of the app's controls
+DEFAULT_PARAMS = dict(S = 100,
+                      Q = 5,
+                      R0 = 100,
+                      immigration = 1,
+                      immigration_on = True,
+                      reproduction_on = True,
+                      death_on = True,
+                      dispersal_on = True,
+                      consumption_radius = 0, # 0: resources are pooled across the system
+                      max_agents = 0) # 0: every individual is its own agent
+
+#########################################################################################
+################################# SIMULATION STATE ######################################
+#########################################################################################
+
+def make_species(S, rng):
+    """ Randomly parameterizes S species. Returns species IDs and an S x traits matrix """
+    ids = rng.integers(0, 0xFFFFFF, size=S)
+    traits = np.empty((S, len(TRAITS)))
+    traits[:, T_GROWTH] = rng.uniform(0.001, 1, size=S)
+    traits[:, T_DISP] = rng.uniform(0, 20, size=S)
+    traits[:, T_RESUSC] = rng.uniform(0.001, 1, size=S)
+    traits[:, T_BMR] = rng.uniform(0.001, 1, size=S)
+    traits[:, T_BMR_RED] = rng.uniform(0.001, 1, size=S)
+    traits[:, T_IMM] = rng.uniform(0.001, 1, size=S)
+    traits[:, T_EFF] = rng.uniform(0.001, 1, size=S)
+    return ids, traits
+
+
+class ResourceRing(object):
+    """ Resource parcels in order of inflow. Every parcel drifts downstream at the same
+        speed, so instead of storing and shifting x-coordinates, each parcel keeps the
+        distance the water had flowed when it entered (inflow) and its x-coordinate is
+        derived as the distance flowed since.
+
+        Parcels occupy a window [head, tail) of preallocated arrays. Inflow writes at the
+        tail and outflow moves the head past the parcels that have left the system (always
+        the oldest), so both are O(1) pointer moves. The window is only moved back to the
+        start of the arrays, or the arrays doubled, when the tail reaches their end; every
+        attribute of the live parcels is therefore a contiguous view. """
+
+    FIELDS = ['rep', 'y', 'size', 'inflow']
+
+    def __init__(self, capacity=64):
+        self.distance = 0.0 # total distance flowed
+        self.head = 0
+        self.tail = 0
+        self.rep = np.empty(capacity, dtype=np.int64)
+        self.y = np.empty(capacity)
+        self.size = np.empty(capacity)
+        self.inflow = np.empty(capacity)
+
+    def __len__(self):
+        return self.tail - self.head
+
+    @property
+    def capacity(self):
+        return self.rep.shape[0]
+
+    def view(self, f):
+        return getattr(self, f)[self.head:self.tail]
+
+    @property
+    def x(self):
+        return self.distance - self.view('inflow')
+
+    def _reserve(self, k):
+        """ Makes room for k more parcels after the tail """
+        if self.tail + k <= self.capacity:
+            return
+        n = len(self)
+        capacity = self.capacity
+        while n + k > capacity // 2:
+            capacity *= 2
+        for f in self.FIELDS:
+            a = np.empty(capacity, dtype=getattr(self, f).dtype)
+            a[:n] = self.view(f)
+            setattr(self, f, a)
+        self.head, self.tail = 0, n
+
+    def add(self, rep, y, size, x=0):
+        """ Adds parcels at x (the inlet by default). Parcels must be added in order of
+            inflow, i.e. of decreasing x """
+        k = np.shape(rep)[0]
+        self._reserve(k)
+        i = slice(self.tail, self.tail + k)
+        self.rep[i] = rep
+        self.y[i] = y
+        self.size[i] = size
+        self.inflow[i] = self.distance - np.asarray(x, dtype=np.float64)
+        self.tail += k
+
+    def flow(self, d):
+        """ Moves all parcels d downstream and drops those that leave the system """
+        self.distance += d
+        self.head += int(np.searchsorted(self.view('inflow'), self.distance - W, side='left'))
+
+    def clear(self):
+        self.head = self.tail = 0
+
+    def copy(self):
+        ring = ResourceRing.__new__(ResourceRing)
+        ring.__dict__.update(self.__dict__)
+        for f in self.FIELDS:
+            setattr(ring, f, getattr(self, f).copy())
+        return ring
+
+
+def _column(f):
+    """ Property exposing the live rows of the per-individual buffer f of an IBMState """
+    def get(self):
+        return self._cols[f][:self._n]
+    def set(self, value):
+        self._cols[f][:self._n] = value
+    return property(get, set)
+
+
+class IBMState(object):
+    """ Struct-of-arrays container for a community of individuals and the resource
+        parcels flowing through the system. Every per-individual attribute is a NumPy
+        array of length n and all arrays are kept aligned. Individuals only store the row
+        of their species (sp) in the species arrays, which are the single source of
+        species IDs, traits and colors.
+
+        A state can hold several independent replicate communities (n_reps > 1). Replicate
+        r owns species rows r*S to (r+1)*S - 1, resource parcels carry the index of their
+        replicate (res_rep), and every process of a time step runs once across all
+        replicates. Resource parcels are held in a ResourceRing; the res_* attributes are
+        views of its live parcels.
+
+        Each row is an agent standing for `weight` identical individuals (see merge and
+        step_weighted); without super-individuals every weight is 1, so N is the sum of
+        the weights rather than n, the number of agents.
+
+        Individual attributes use compact dtypes: uint32 IDs (which wrap around after
+        2**32 births) and weights, uint16 species rows (uint32 for very large species
+        pools), int32 ages and uint8 metabolic states and symbol codes. Positions, resource quotas and
+        body sizes are float64, or float32 when `dtype=np.float32` is given.
+
+        Per-individual attributes are views of the first n rows of preallocated buffers
+        whose capacity doubles when full. Births and immigrants are written into the spare
+        capacity, and deaths are removed by one stable compaction of the buffers in place,
+        moving COMPACT_BLOCK rows at a time, so a time step does not allocate new copies of
+        the population's columns (only the index of the survivors). Attributes can be
+        updated in place or assigned whole (with n values); to change n use append,
+        select and clear. """
+
+    IND_FIELDS = ['ind_id', 'sp', 'x', 'y', 'quota', 'size', 'age', 'state', 'symbol', 'weight']
+    RES_FIELDS = ['res_rep', 'res_x', 'res_y', 'res_size']
+
+    ind_id = _column('ind_id')
+    sp = _column('sp')         # row in the species arrays
+    x = _column('x')
+    y = _column('y')
+    quota = _column('quota')
+    size = _column('size')
+    age = _column('age')
+    state = _column('state')   # 0 = dormant, 1 = active
+    symbol = _column('symbol') # OPEN or FILLED
+    weight = _column('weight') # individuals represented by each agent
+
+    def __init__(self, sp_ids, sp_traits, seed=None, n_reps=1, dtype=np.float64, capacity=1024):
+        self.rng = np.random.default_rng(seed)
+        self.n_reps = n_reps
+        self.dtype = np.dtype(dtype)
+
+        self.sp_ids = np.asarray(sp_ids, dtype=np.int64)
+        self.sp_traits = np.asarray(sp_traits, dtype=np.float64)
+        self.sp_colors = np.array(["#" + "%06x" % i for i in self.sp_ids], dtype=object)
+
+        self.sp_dtype = np.dtype(np.uint16 if self.sp_ids.shape[0] <= 2**16 else np.uint32)
+
+        self.next_id = 0
+        self._n = 0
+        dtypes = dict(ind_id = np.uint32, sp = self.sp_dtype, x = self.dtype, y = self.dtype,
+                      quota = self.dtype, size = self.dtype, age = np.int32, state = np.uint8,
+                      symbol = np.uint8, weight = np.uint32)
+        self._cols = {f: np.empty(capacity, dtype=dtypes[f]) for f in self.IND_FIELDS}
+
+        self.resources = ResourceRing()
+
+    @classmethod
+    def new(cls, S, seed=None, replicates=1, dtype=np.float64):
+        """ Returns a state with S randomly parameterized species and one individual of each,
+            in each of `replicates` independent communities """
+        rng = np.random.default_rng(seed)
+        sp_ids, sp_traits = make_species(S*replicates, rng)
+        state = cls(sp_ids, sp_traits, n_reps=replicates, dtype=dtype)
+        state.rng = rng
+        state.seed_individuals()
+        return state
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def capacity(self):
+        return self._cols['ind_id'].shape[0]
+
+    @property
+    def res_rep(self):
+        return self.resources.view('rep')
+
+    @property
+    def res_x(self):
+        return self.resources.x
+
+    @property
+    def res_y(self):
+        return self.resources.view('y')
+
+    @property
+    def res_size(self):
+        return self.resources.view('size')
+
+    @res_size.setter
+    def res_size(self, value):
+        self.resources.view('size')[:] = value
+
+    def set_resources(self, rep, x, y, size):
+        """ Replaces the resource parcels """
+        order = np.argsort(-np.asarray(x), kind='stable')
+        self.resources = ResourceRing(max(64, 2*order.shape[0]))
+        self.resources.add(np.asarray(rep)[order], np.asarray(y)[order],
+                           np.asarray(size)[order], np.asarray(x)[order])
+
+    @property
+    def n_species(self):
+        """ Number of species in the pool of each replicate """
+        return self.sp_ids.shape[0] // self.n_reps
+
+    @property
+    def rep(self):
+        """ Replicate of every individual """
+        return self.sp // self.n_species
+
+    @property
+    def species_id(self):
+        return self.sp_ids[self.sp]
+
+    @property
+    def color(self):
+        return self.sp_colors[self.sp]
+
+    @property
+    def symbol_names(self):
+        return SYMBOLS[self.symbol]
+
+    def trait(self, t, idx=slice(None)):
+        """ Gathers trait column t (e.g. T_BMR) for all individuals or those in idx """
+        return self.sp_traits[self.sp[idx], t]
+
+    def nbytes(self):
+        """ Memory held by the per-individual arrays """
+        return sum(getattr(self, f).nbytes for f in self.IND_FIELDS)
+
+    def new_ids(self, k):
+        """ Returns k new individual IDs """
+        ids = ((self.next_id + np.arange(k)) % 2**32).astype(np.uint32)
+        self.next_id += k
+        return ids
+
+    def seed_individuals(self, reps=None):
+        """ Adds one individual of each species at the inflow boundary, in every replicate
+            or only in the given replicates """
+        if reps is None:
+            reps = np.arange(self.n_reps)
+        S = self.n_species
+        sp_idx = (np.asarray(reps)[:, None]*S + np.arange(S)).ravel()
+        self.add_individuals(sp_idx, self.rng.uniform(0, H, size=sp_idx.shape[0]))
+
+    def add_individuals(self, sp_idx, y):
+        """ Appends new individuals (age 0, active, at x = 0) of the given species rows """
+        k = len(sp_idx)
+        if k == 0:
+            return
+        self.append(ind_id = self.new_ids(k),
+                    sp = sp_idx,
+                    x = np.zeros(k),
+                    y = y,
+                    quota = np.full(k, 10.0),
+                    size = np.full(k, 10.0),
+                    age = np.zeros(k),
+                    state = np.ones(k),
+                    symbol = np.full(k, FILLED),
+                    weight = np.ones(k))
+
+    def _reserve(self, n):
+        """ Grows the buffers, doubling their capacity, until they hold n individuals """
+        capacity = self.capacity
+        if n <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < n:
+            capacity *= 2
+        for f in self.IND_FIELDS:
+            a = np.empty(capacity, dtype=self._cols[f].dtype)
+            a[:self._n] = self._cols[f][:self._n]
+            self._cols[f] = a
+
+    def append(self, **cols):
+        """ Appends rows to every per-individual array, casting them to its dtype """
+        k = np.shape(cols['ind_id'])[0]
+        self._reserve(self._n + k)
+        for f in self.IND_FIELDS:
+            self._cols[f][self._n:self._n + k] = cols[f]
+        self._n += k
+
+    def select(self, idx):
+        """ Keeps only the individuals selected by a boolean mask or sorted index array,
+            compacting the buffers in place """
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            if idx.all():
+                return
+            idx = np.flatnonzero(idx)
+        k = idx.shape[0]
+        # rows before the first removed one stay where they are: idx[t] == t up to it and
+        # idx[t] > t from it on, so it is found by binary search
+        first, hi = 0, k
+        while first < hi:
+            mid = (first + hi) // 2
+            if idx[mid] == mid:
+                first = mid + 1
+            else:
+                hi = mid
+        for f in self.IND_FIELDS:
+            a = self._cols[f]
+            # idx is ascending, so rows only ever move towards the front and each block
+            # reads rows at or after those it writes; only one block is copied at a time
+            for s in range(first, k, COMPACT_BLOCK):
+                e = min(s + COMPACT_BLOCK, k)
+                a[s:e] = a[idx[s:e]]
+        self._n = k
+
+    def merge(self, max_agents):
+        """ Merges agents of the same species and metabolic state that are close in position,
+            resource quota and body size, so that at most max_agents agents remain (or as
+            few as a grid of MERGE_BINS[-1] bins allows). Agents are binned on a grid that
+            is coarsened until that is so; each bin becomes one agent with the summed weight
+            and the weighted mean position, quota, size and age, so N, S and the total quota
+            and biomass are unchanged """
+        if self.n <= max_agents:
+            return
+        w = self.weight.astype(np.float64)
+        dims = [(self.x, 0, W), (self.y, 0, H)]
+        for v in (np.log1p(self.quota), np.log1p(self.size)):
+            dims.append((v, v.min(), v.max()))
+
+        base = self.sp.astype(np.int64)*2 + self.state
+        for b in MERGE_BINS:
+            key = base
+            for v, lo, hi in dims:
+                key = key*b + np.clip(((v - lo)*(b/max(hi - lo, 1e-12))).astype(np.int64), 0, b - 1)
+            groups, first, inv = np.unique(key, return_index=True, return_inverse=True)
+            if groups.shape[0] <= max_agents:
+                break
+
+        # number groups by their first agent, which is kept and takes the merged values
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+        g = rank[inv.ravel()]
+        total = np.bincount(g, weights=w)
+        mean = lambda v: np.bincount(g, weights=w*v)/total
+        merged = dict(x = mean(self.x), y = mean(self.y), quota = mean(self.quota),
+                      size = mean(self.size), age = np.rint(mean(self.age)), weight = total)
+        self.select(first[order])
+        for f, v in merged.items():
+            setattr(self, f, v)
+
+    def clear(self):
+        """ Removes all individuals and resources """
+        self.select(np.zeros(self.n, dtype=bool))
+        self.resources.clear()
+
+    def copy(self):
+        """ Returns a copy of the state that shares no arrays (but does share the RNG) """
+        state = IBMState.__new__(IBMState)
+        state.__dict__.update(self.__dict__)
+        state._cols = {f: getattr(self, f).copy() for f in self.IND_FIELDS}
+        state.resources = self.resources.copy()
+        return state
+
+    def summary(self):
+        """ Returns total abundance (N), species richness (S) and total resources """
+        return int(np.sum(self.weight, dtype=np.int64)), np.unique(self.sp).shape[0], float(np.sum(self.res_size))
+
+    def summaries(self):
+        """ Returns arrays of N, S and total resources with one entry per replicate """
+        N = np.bincount(self.rep, weights=self.weight, minlength=self.n_reps).astype(np.int64)
+        S = np.bincount(np.unique(self.sp) // self.n_species, minlength=self.n_reps)
+        R = np.bincount(self.res_rep, weights=self.res_size, minlength=self.n_reps)
+        return N, S, R
+
+    #####################################################################################
+    ############################## DATAFRAME CONVERSION #################################
+    #####################################################################################
+
+    def species_frame(self):
+        species = pd.DataFrame({'Species ID': self.sp_ids})
+        for i, t in enumerate(TRAITS):
+            species[t] = self.sp_traits[:, i]
+        species['color'] = self.sp_colors
+        return species
+
+    def individuals_frame(self):
+        """ Returns the individuals with their species' traits, one column per attribute """
+        df = pd.DataFrame({'Species ID': self.species_id})
+        for i, t in enumerate(TRAITS):
+            df[t] = self.trait(i)
+        df['color'] = self.color
+        df['Ind ID'] = self.ind_id
+        df['age'] = self.age
+        df['x_coord'] = self.x
+        df['y_coord'] = self.y
+        df['resource quota'] = self.quota
+        df['body size'] = self.size
+        df['metabolic state'] = self.state
+        df['symbol'] = self.symbol_names
+        df['weight'] = self.weight
+        return df
+
+    def resources_frame(self):
+        return pd.DataFrame({'Resource ID': np.ones(self.res_x.shape[0], dtype=np.int64),
+                             'x_coord': self.res_x,
+                             'y_coord': self.res_y,
+                             'size': self.res_size})
+
+    @classmethod
+    def from_frames(cls, species, individuals=None, resources=None, seed=None):
+        """ Rebuilds a state from the species, individuals and resources DataFrames """
+        state = cls(species['Species ID'].to_numpy(), species[TRAITS].to_numpy(dtype=np.float64),
+                    seed=seed)
+
+        if individuals is not None and individuals.shape[0] > 0:
+            rows = pd.Series(np.arange(state.sp_ids.shape[0]), index=state.sp_ids)
+            rows = rows[~rows.index.duplicated()]
+            state.append(ind_id = individuals['Ind ID'].to_numpy(),
+                         sp = rows.loc[individuals['Species ID'].to_numpy()].to_numpy(),
+                         x = individuals['x_coord'].to_numpy(),
+                         y = individuals['y_coord'].to_numpy(),
+                         quota = individuals['resource quota'].to_numpy(),
+                         size = individuals['body size'].to_numpy(),
+                         age = individuals['age'].to_numpy(),
+                         state = individuals['metabolic state'].to_numpy(),
+                         symbol = (individuals['symbol'] == 'circle').to_numpy(),
+                         weight = individuals['weight'].to_numpy() if 'weight' in individuals else 1)
+            state.next_id = int(np.max(state.ind_id)) + 1
+
+        if resources is not None and resources.shape[0] > 0:
+            state.set_resources(np.zeros(resources.shape[0], dtype=np.int64),
+                                resources['x_coord'].to_numpy(dtype=np.float64),
+                                resources['y_coord'].to_numpy(dtype=np.float64),
+                                resources['size'].to_numpy(dtype=np.float64))
+
+        return state
+
+    #####################################################################################
+    ################################## CHECKPOINTS ######################################
+    #####################################################################################
+
+    def to_arrays(self):
+        """ Returns every array of the state by name. Scalars and the state of the RNG are
+            packed as a JSON string under 'meta' """
+        arrays = {f: getattr(self, f) for f in ['sp_ids', 'sp_traits'] + self.IND_FIELDS + self.RES_FIELDS}
+        arrays['meta'] = np.array(json.dumps(dict(n_reps = self.n_reps,
+                                                  dtype = self.dtype.name,
+                                                  next_id = self.next_id,
+                                                  rng = self.rng.bit_generator.state)))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ Rebuilds a state from the arrays of to_arrays, including its RNG, so a restored
+            state continues exactly as the saved one would have """
+        meta = json.loads(str(arrays['meta']))
+        state = cls(arrays['sp_ids'], arrays['sp_traits'], n_reps=meta['n_reps'], dtype=meta['dtype'])
+        state.next_id = meta['next_id']
+        name = meta['rng']['bit_generator']
+        if name not in BIT_GENERATORS:
+            raise ValueError('unknown bit generator %r' % name)
+        bit_generator = BIT_GENERATORS[name]()
+        bit_generator.state = meta['rng']
+        state.rng = np.random.Generator(bit_generator)
+        # checkpoints from before super-individuals have no weights
+        n = arrays['ind_id'].shape[0]
+        state.append(**{f: arrays[f] if f in arrays else np.ones(n) for f in cls.IND_FIELDS})
+        state.set_resources(*[arrays[f] for f in cls.RES_FIELDS])
+        return state
+
+
+def save_checkpoint(file, state, **arrays):
+    """ Writes a state, and any extra arrays, to an uncompressed .npz file. Every array is
+        stored as a plain .npy member, so restoring is a straight copy with no decoding """
+    np.savez(file, **state.to_arrays(), **arrays)
+
+
+def load_checkpoint(file):
+    """ Reads a checkpoint written by save_checkpoint. Returns the state and a dict of the
+        extra arrays """
+    with np.load(file, allow_pickle=False) as data:
+        arrays = {k: data[k] for k in data.files}
+    state = IBMState.from_arrays(arrays)
+    extra = {k: v for k, v in arrays.items() if k not in state.to_arrays()}
+    return state, extra
+
+#########################################################################################
+################################# SPATIAL INDEX #########################################
+#########################################################################################
+
+DENSE_CELLS = 2**22 # largest grid of cells held as a lookup table by neighbor_pairs
+
+
+def neighbor_pairs(x, y, rep, px, py, prep, radius):
+    """ Returns index arrays (i, j) of every point (x[i], y[i]) and parcel (px[j], py[j]) of
+        the same replicate that lie within radius of each other.
+
+        Parcels are hashed into a uniform grid with cells of side radius, and each point is
+        only compared with the parcels of its own and the 8 surrounding cells, so the work
+        is proportional to the number of points times the parcels per cell rather than to
+        points times parcels. Only the parcels are indexed; points are never sorted. """
+    r = float(radius)
+    pcx = np.floor(px / r).astype(np.int64)
+    pcy = np.floor(py / r).astype(np.int64)
+    cx = np.floor(x / r).astype(np.int64)
+    cy = np.floor(y / r).astype(np.int64)
+
+    # the grid spans every point and parcel (which may have drifted past W) with a margin
+    # of one cell, so the neighbours of every cell are distinct cells of the grid
+    x0 = min(cx.min(initial=0), pcx.min(initial=0))
+    y0 = min(cy.min(initial=0), pcy.min(initial=0))
+    nx = int(max(cx.max(initial=0), pcx.max(initial=0)) - x0) + 3
+    ny = int(max(cy.max(initial=0), pcy.max(initial=0)) - y0) + 3
+
+    def cell_key(rep, cx, cy):
+        return (rep.astype(np.int64) * nx + (cx - x0 + 1)) * ny + (cy - y0 + 1)
+
+    keys = cell_key(prep, pcx, pcy)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+
+    # first sorted parcel and number of parcels of every cell, looked up directly by key
+    # when the table of cells is small enough, else by binary search
+    n_cells = (int(max(rep.max(initial=0), prep.max(initial=0))) + 1) * nx * ny
+    if n_cells <= DENSE_CELLS:
+        cell_count = np.bincount(keys, minlength=n_cells)
+        cell_start = np.cumsum(cell_count) - cell_count
+        lookup = lambda k: (cell_start[k], cell_count[k])
+    else:
+        def lookup(k):
+            lo = np.searchsorted(keys, k, side='left')
+            return lo, np.searchsorted(keys, k, side='right') - lo
+
+    points = np.arange(x.shape[0])
+    ii, jj = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            lo, count = lookup(cell_key(rep, cx + dx, cy + dy))
+            total = int(count.sum())
+            if total == 0:
+                continue
+            # expand each point's run of parcels in the sorted keys
+            start = np.repeat(lo - (np.cumsum(count) - count), count)
+            ii.append(np.repeat(points, count))
+            jj.append(order[start + np.arange(total)])
+
+    if not ii:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    i = np.concatenate(ii)
+    j = np.concatenate(jj)
+    near = (x[i] - px[j])**2 + (y[i] - py[j])**2 <= r*r
+    return i[near], j[near]
+
+#########################################################################################
+################################# MODEL DYNAMICS ########################################
+#########################################################################################
+
+def resource_shares(state, ia, x, y, rr, flow, consumption_radius=0, weight=None):
+    """ Resources available to the active individuals ia (with positions x, y and
+        replicates rr) before consumption. Returns, per individual, the share it may
+        consume and the resources it can reach (which set its chance of feeding), and a
+        function that removes the consumed amounts from the resource parcels. With
+        weights, each of ia is an agent of that many individuals, which all get a share,
+        and the consumed amounts are an agent's totals.
+
+        Resources are pooled within each replicate and shared per capita, or with
+        consumption_radius > 0, each parcel is shared per capita among the individuals
+        within the radius (see neighbor_pairs). Individuals have already drifted with this
+        time step's flow, so parcels are compared at their drifted positions """
+    if consumption_radius > 0:
+        n_res = state.res_size.shape[0]
+        i, j = neighbor_pairs(x, y, rr, state.res_x + flow, state.res_y, state.res_rep,
+                              consumption_radius)
+        count = np.bincount(j, weights=None if weight is None else weight[i], minlength=n_res)
+        share = state.res_size[j] / count[j]
+        A = np.bincount(i, weights=share, minlength=ia.shape[0])
+        R = np.bincount(i, weights=state.res_size[j], minlength=ia.shape[0])
+
+        def deplete(consumed):
+            # each individual takes the same fraction of each of its shares
+            with np.errstate(divide='ignore', invalid='ignore'):
+                f = np.where(A > 0, consumed/A, 0)
+            taken = np.bincount(j, weights=f[i] * share, minlength=n_res)
+            state.res_size = np.maximum(state.res_size - taken, 0)
+        return A, R, deplete
+
+    n_reps = state.n_reps
+    R = np.bincount(state.res_rep, weights=state.res_size, minlength=n_reps)
+    n = np.bincount(rr, weights=weight, minlength=n_reps)
+
+    def deplete(consumed):
+        # every parcel shrinks in proportion
+        R_left = np.maximum(R - np.bincount(rr, weights=consumed, minlength=n_reps), 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(R > 0, R_left/R, 0)
+        state.res_size = state.res_size * scale[state.res_rep]
+    return R[rr]/n[rr], R[rr], deplete
+
+
+def step_numpy(state, flow, reproduction_on, death_on, dispersal_on, consumption_radius):
+    """ Applies the processes of a time step to every individual with whole-array
+        operations. Returns the survivors mask and the progeny (parents, quotas, sizes) """
+    rng = state.rng
+    traits = state.sp_traits
+    active = state.state == 1
+    dormant = ~active
+    new_state = state.state.copy()
+    keep = np.zeros(state.n, dtype=bool)
+    progeny = None
+
+    ia = np.flatnonzero(active)
+    if ia.shape[0] > 0:
+        quota = state.quota[ia]
+        size = state.size[ia]
+        x = state.x[ia]
+        age = state.age[ia] + 1
+        spa = state.sp[ia]
+        bmr = traits[spa, T_BMR]
+
+        # resource consumption
+        rr = spa // state.n_species
+        share, R, deplete = resource_shares(state, ia, x, state.y[ia], rr, flow, consumption_radius)
+        p = rng.binomial(1, R/(1 + R))
+        consumed = np.minimum(share, traits[spa, T_EFF] * size) * p
+        quota += consumed
+        deplete(consumed)
+
+        # growth
+        g = np.minimum(size * traits[spa, T_GROWTH], quota)
+        size += g
+        quota -= g
+
+        # active dispersal inside the system
+        if dispersal_on:
+            d = np.minimum(np.minimum(x, traits[spa, T_DISP]), quota)
+            x -= d
+            quota -= d/W
+
+        # active maintenance
+        quota -= bmr
+
+        # death and outflow
+        alive = x <= W
+        if death_on:
+            alive &= quota >= 0
+        quota[~(quota > 0)] = 0
+
+        # reproduction
+        if reproduction_on:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ri = quota/bmr
+                p = ri/(1 + ri) * size/(20 + size) * age/(20 + age)
+            p[~np.isfinite(p)] = 0
+            repro = (rng.binomial(1, p) == 1) & alive
+            size[repro] /= 2
+            quota[repro] /= 2
+            if np.any(repro):
+                progeny = ia[repro], quota[repro], size[repro]
+
+        # transition to dormancy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lambda_ = quota/bmr
+            p = 1/(1 + lambda_) * age/(10 + age)
+        p[~np.isfinite(p)] = 0
+        new_state[ia] = 1 - rng.binomial(1, p)
+
+        state.quota[ia] = quota
+        state.size[ia] = size
+        state.x[ia] = x
+        state.age[ia] = age
+        state.symbol[ia] = FILLED
+        keep[ia] = alive
+
+    idd = np.flatnonzero(dormant)
+    if idd.shape[0] > 0:
+        # dormant maintenance
+        spd = state.sp[idd]
+        quota = state.quota[idd] - traits[spd, T_BMR] * traits[spd, T_BMR_RED]
+        quota[~(quota > 0)] = 0
+        state.quota[idd] = quota
+
+        # transition to activity
+        new_state[idd] = rng.binomial(1, traits[spd, T_RESUSC])
+
+        state.age[idd] += 1
+        state.symbol[idd] = OPEN
+
+        # outflow
+        keep[idd] = state.x[idd] <= W
+
+    state.state = new_state
+    return keep, progeny
+
+#########################################################################################
+################################# SUPER-INDIVIDUALS #####################################
+#########################################################################################
+
+def split(rng, cols, p):
+    """ Draws how many individuals of every agent in cols (a dict of arrays, with the
+        agents' weights under 'weight') succeed at an event of probability p. An agent
+        whose individuals do not all share one outcome is split: it keeps the successes,
+        and a copy appended to every array of cols takes the failures. Returns the mask
+        of succeeding agents """
+    w = cols['weight']
+    m = w.shape[0]
+    k = rng.binomial(w, p)
+    part = np.flatnonzero((k > 0) & (k < w))
+    for f, c in cols.items():
+        cols[f] = np.concatenate([c, c[part]])
+    cols['weight'][:m] = np.where(k > 0, k, w)
+    cols['weight'][m:] = w[part] - k[part]
+    return np.concatenate([k > 0, np.zeros(part.shape[0], dtype=bool)])
+
+
+def step_weighted(state, flow, reproduction_on, death_on, dispersal_on, consumption_radius):
+    """ Same as step_numpy for agents that each stand for `weight` individuals. The chance
+        events of a time step (feeding, reproduction and changes of metabolic state) are
+        drawn for all individuals of an agent at once as a binomial number of successes,
+        splitting agents whose individuals differ (see split); death and outflow act on
+        whole agents. Split-off agents are appended to the state, and the survivors mask
+        and progeny cover them """
+    rng = state.rng
+    traits = state.sp_traits
+    n = state.n
+    weight = state.weight.astype(np.int64)
+    new_state = state.state.copy()
+    keep = np.zeros(n, dtype=bool)
+    progeny = None
+    added = [] # columns of split-off agents, which follow their originals in cols
+
+    ia = np.flatnonzero(state.state == 1)
+    if ia.shape[0] > 0:
+        na = ia.shape[0]
+        rr = state.sp[ia] // state.n_species
+        share, R, deplete = resource_shares(state, ia, state.x[ia], state.y[ia], rr, flow,
+                                            consumption_radius, weight[ia])
+        a = dict(weight = weight[ia], row = ia, agent = np.arange(na), share = share,
+                 quota = state.quota[ia].astype(np.float64),
+                 size = state.size[ia].astype(np.float64),
+                 x = state.x[ia].astype(np.float64), age = state.age[ia] + 1)
+
+        # resource consumption
+        fed = split(rng, a, R/(1 + R))
+        spa = state.sp[a['row']]
+        consumed = np.minimum(a['share'], traits[spa, T_EFF] * a['size']) * fed
+        a['quota'] += consumed
+        deplete(np.bincount(a['agent'], weights=consumed*a['weight'], minlength=na))
+
+        # growth
+        quota, size, x, age = a['quota'], a['size'], a['x'], a['age']
+        bmr = traits[spa, T_BMR]
+        g = np.minimum(size * traits[spa, T_GROWTH], quota)
+        size += g
+        quota -= g
+
+        # active dispersal inside the system
+        if dispersal_on:
+            d = np.minimum(np.minimum(x, traits[spa, T_DISP]), quota)
+            x -= d
+            quota -= d/W
+
+        # active maintenance
+        quota -= bmr
+
+        # death and outflow
+        alive = x <= W
+        if death_on:
+            alive &= quota >= 0
+        quota[~(quota > 0)] = 0
+        a['alive'] = alive
+
+        # reproduction
+        a['repro'] = np.zeros(quota.shape[0], dtype=bool)
+        if reproduction_on:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ri = quota/bmr
+                p = ri/(1 + ri) * size/(20 + size) * age/(20 + age)
+            p[~(np.isfinite(p) & alive)] = 0
+            repro = split(rng, a, p)
+            a['size'][repro] /= 2
+            a['quota'][repro] /= 2
+            a['repro'] = repro
+
+        # transition to dormancy
+        bmr = traits[state.sp[a['row']], T_BMR]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lambda_ = a['quota']/bmr
+            p = 1/(1 + lambda_) * a['age']/(10 + a['age'])
+        p[~np.isfinite(p)] = 0
+        a['state'] = 1 - split(rng, a, p)
+
+        for f in ['quota', 'size', 'x', 'age', 'weight']:
+            getattr(state, f)[ia] = a[f][:na]
+        new_state[ia] = a['state'][:na]
+        state.symbol[ia] = FILLED
+        keep[ia] = a['alive'][:na]
+        a['symbol'] = np.full(a['weight'].shape[0], FILLED)
+        added.append((a, na))
+
+    idd = np.flatnonzero(state.state == 0)
+    if idd.shape[0] > 0:
+        nd = idd.shape[0]
+        spd = state.sp[idd]
+        d = dict(weight = weight[idd], row = idd,
+                 quota = state.quota[idd] - traits[spd, T_BMR] * traits[spd, T_BMR_RED],
+                 age = state.age[idd] + 1)
+
+        # dormant maintenance
+        d['quota'][~(d['quota'] > 0)] = 0
+
+        # transition to activity
+        d['state'] = split(rng, d, traits[spd, T_RESUSC]).astype(np.uint8)
+
+        # outflow
+        d['alive'] = state.x[d['row']] <= W
+        d['repro'] = np.zeros(d['weight'].shape[0], dtype=bool)
+        d['size'] = state.size[d['row']]
+        d['x'] = state.x[d['row']]
+        d['symbol'] = np.full(d['weight'].shape[0], OPEN)
+
+        for f in ['quota', 'age', 'weight']:
+            getattr(state, f)[idd] = d[f][:nd]
+        new_state[idd] = d['state'][:nd]
+        state.symbol[idd] = OPEN
+        keep[idd] = d['alive'][:nd]
+        added.append((d, nd))
+
+    state.state = new_state
+
+    # append the split-off agents, which may have progeny like their originals
+    for c, m in added:
+        k = c['weight'].shape[0] - m
+        first = state.n
+        state.append(ind_id = state.new_ids(k),
+                     sp = state.sp[c['row'][m:]],
+                     x = c['x'][m:],
+                     y = state.y[c['row'][m:]],
+                     quota = c['quota'][m:],
+                     size = c['size'][m:],
+                     age = c['age'][m:],
+                     state = c['state'][m:],
+                     symbol = c['symbol'][m:],
+                     weight = c['weight'][m:])
+        keep = np.concatenate([keep, c['alive'][m:]])
+        if np.any(c['repro']):
+            rows = np.concatenate([c['row'][:m], first + np.arange(k)])
+            progeny = rows[c['repro']], c['quota'][c['repro']], c['size'][c['repro']]
+    return keep, progeny
+
+#########################################################################################
+################################# FUSED KERNEL ##########################################
+#########################################################################################
+
+def fused_tick(status, sp, x, quota, size, age, symbol, traits, share, R, u,
+               reproduction_on, death_on, dispersal_on, keep, consumed, repro):
+    """ The processes of step_numpy in one pass over the individuals, written element by
+        element for Numba. share and R are the resource shares and reachable resources
+        of every individual (0 for dormant ones), and u holds three uniform draws per
+        individual that decide feeding, reproduction and changes of metabolic state.
+        Updates the population arrays in place and fills keep, consumed and repro """
+    for i in range(status.shape[0]):
+        s = sp[i]
+        bmr = traits[s, T_BMR]
+        if status[i] == 1:
+            a = age[i] + 1
+            q = quota[i]
+            z = size[i]
+            xi = x[i]
+
+            # resource consumption
+            c = 0.0
+            if u[i, 0] < R[i]/(1 + R[i]):
+                c = min(share[i], traits[s, T_EFF] * z)
+            q += c
+            consumed[i] = c
+
+            # growth
+            g = min(z * traits[s, T_GROWTH], q)
+            z += g
+            q -= g
+
+            # active dispersal inside the system
+            if dispersal_on:
+                d = min(min(xi, traits[s, T_DISP]), q)
+                xi -= d
+                q -= d/W
+
+            # active maintenance, death and outflow
+            q -= bmr
+            alive = xi <= W
+            if death_on and q < 0:
+                alive = False
+            if not q > 0:
+                q = 0.0
+
+            # reproduction
+            r = False
+            if reproduction_on and alive:
+                ri = q/bmr
+                p = ri/(1 + ri) * z/(20 + z) * a/(20 + a)
+                if u[i, 1] < p:
+                    r = True
+                    z /= 2
+                    q /= 2
+
+            # transition to dormancy
+            p = 1/(1 + q/bmr) * a/(10 + a)
+            status[i] = 0 if u[i, 2] < p else 1
+
+            quota[i] = q
+            size[i] = z
+            x[i] = xi
+            age[i] = a
+            symbol[i] = FILLED
+            keep[i] = alive
+            repro[i] = r
+        else:
+            # dormant maintenance
+            q = quota[i] - bmr * traits[s, T_BMR_RED]
+            quota[i] = q if q > 0 else 0.0
+
+            # transition to activity
+            status[i] = 1 if u[i, 2] < traits[s, T_RESUSC] else 0
+
+            age[i] += 1
+            symbol[i] = OPEN
+            keep[i] = x[i] <= W
+            consumed[i] = 0.0
+            repro[i] = False
+
+
+try:
+    import numba
+    _fused_tick = numba.njit(cache=True, nogil=True)(fused_tick)
+except ImportError:
+    _fused_tick = None
+
+HAVE_NUMBA = _fused_tick is not None
+
+
+def step_fused(state, flow, reproduction_on, death_on, dispersal_on, consumption_radius):
+    """ Same as step_numpy, with the per-individual processes fused into one compiled
+        pass (fused_tick). Random draws come from the state's RNG but are used differently,
+        so results are statistically, not bitwise, identical to step_numpy """
+    n = state.n
+    share = np.zeros(n)
+    R = np.zeros(n)
+    ia = np.flatnonzero(state.state == 1)
+    deplete = None
+    if ia.shape[0] > 0:
+        rr = state.sp[ia] // state.n_species
+        share[ia], R[ia], deplete = resource_shares(state, ia, state.x[ia], state.y[ia], rr,
+                                                    flow, consumption_radius)
+
+    keep = np.empty(n, dtype=np.bool_)
+    consumed = np.empty(n)
+    repro = np.empty(n, dtype=np.bool_)
+    _fused_tick(state.state, state.sp, state.x, state.quota, state.size, state.age,
+                state.symbol, state.sp_traits, share, R, state.rng.random((n, 3)),
+                reproduction_on, death_on, dispersal_on, keep, consumed, repro)
+    if deplete is not None:
+        deplete(consumed[ia])
+
+    progeny = None
+    parents = np.flatnonzero(repro)
+    if parents.shape[0] > 0:
+        progeny = parents, state.quota[parents], state.size[parents]
+    return keep, progeny
+
+
+def step(state, Q, R0, immigration=0, immigration_on=True, reproduction_on=True,
+         death_on=True, dispersal_on=True, consumption_radius=0, max_agents=0, jit=False):
+    """ Advances the model one time step. Every process acts on whole arrays through
+        boolean masks; individuals are only copied once, when the survivors and progeny
+        of the time step are assembled. Sums over a replicate's individuals or resources
+        are taken with np.bincount, so all replicates of a state are stepped together.
+
+        With consumption_radius > 0, individuals only consume resource parcels within
+        that distance of them (see neighbor_pairs) instead of the replicate's pooled
+        resources. With jit=True, the per-individual processes run in one compiled pass
+        (step_fused) when Numba is installed, and as NumPy array operations otherwise.
+
+        With max_agents > 0, agents are super-individuals that stand for many individuals
+        of the same species and state (step_weighted, which ignores jit), and are merged
+        whenever there are more than max_agents of them (IBMState.merge). N and S stay
+        exact while memory and time per step are bounded by max_agents. """
+
+    rng = state.rng
+    flow = (Q*0.01)*W
+    n_reps = state.n_reps
+    reps = np.arange(n_reps)
+
+    # resource inflow, one parcel per replicate
+    state.resources.add(reps, rng.uniform(0, H, size=n_reps), np.full(n_reps, R0*Q, dtype=np.float64))
+
+    # immigration, sampling each replicate's species pool by immigration rate
+    if immigration > 0 and immigration_on:
+        im = int(immigration*Q)
+        if im > 0:
+            S = state.n_species
+            cdf = np.cumsum(state.sp_traits[:, T_IMM].reshape(n_reps, S), axis=1)
+            cdf = cdf/cdf[:, -1:] + reps[:, None]
+            u = rng.random((n_reps, im)) + reps[:, None]
+            sp_idx = np.searchsorted(cdf.ravel(), u.ravel(), side='right')
+            sp_idx = np.minimum(sp_idx, (np.repeat(reps, im) + 1)*S - 1)
+            state.add_individuals(sp_idx, rng.uniform(0, H, size=sp_idx.shape[0]))
+
+    if state.n > 0:
+        state.select(state.quota >= 0)
+        state.x += flow
+
+        if max_agents > 0:
+            processes = step_weighted
+        else:
+            processes = step_fused if jit and HAVE_NUMBA else step_numpy
+        keep, progeny = processes(state, flow, reproduction_on, death_on, dispersal_on,
+                                  consumption_radius)
+
+        if progeny is not None:
+            # progeny inherit their parent's species and position, with a small jitter in y
+            parents, quota, size = progeny
+            k = parents.shape[0]
+            y = np.clip(state.y[parents] + rng.uniform(-1, 1, size=k), 0, H)
+            cols = dict(ind_id = state.new_ids(k),
+                        sp = state.sp[parents],
+                        x = state.x[parents],
+                        y = y,
+                        quota = quota,
+                        size = size,
+                        age = np.zeros(k),
+                        state = np.ones(k),
+                        symbol = np.full(k, FILLED),
+                        weight = state.weight[parents])
+            state.select(keep)
+            state.append(**cols)
+        else:
+            state.select(keep)
+
+        if max_agents > 0:
+            state.merge(max_agents)
+
+    # resource drift and outflow
+    state.resources.flow(flow)
+
+
+def advance(state, params, ticks=1, jit=False):
+    """ Advances the model `ticks` time steps with the parameters of a params dict (S, Q,
+        R0, immigration and the on/off toggles). An extinct community is reseeded with one
+        individual of each species. Returns (N, S, total resources) after every step; for
+        a state with several replicates, each entry is a tuple of per-replicate arrays.
+        jit is passed on to step. """
+    history = []
+    for t in range(ticks):
+        if state.n_reps == 1:
+            if state.n == 0:
+                state.seed_individuals()
+        else:
+            extinct = np.flatnonzero(np.bincount(state.rep, minlength=state.n_reps) == 0)
+            if extinct.shape[0] > 0:
+                state.seed_individuals(extinct)
+
+        step(state, params['Q'], params['R0'],
+             immigration = params['immigration'],
+             immigration_on = params['immigration_on'],
+             reproduction_on = params['reproduction_on'],
+             death_on = params['death_on'],
+             dispersal_on = params['dispersal_on'],
+             consumption_radius = params['consumption_radius'],
+             max_agents = params['max_agents'],
+             jit = jit)
+
+        if state.n_reps == 1:
+            history.append(state.summary())
+        else:
+            history.append(state.summaries())
+    return history
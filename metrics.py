@@ -0,0 +1,180 @@
+""" Lightweight timing of the phases of simulating and drawing frames.
+
+Phases are timed with METRICS.timer and aggregated into global histograms, labelled by
+phase and population size class, and per-session histograms that also keep a moving
+average of recent durations for the app's performance panel. Calls of callbacks and model
+steps are counted with METRICS.count, so they can be compared per tick of the browser.
+render_prometheus formats everything in the Prometheus text exposition format.
+"""
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (s) of the histogram buckets
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# upper bounds of the population size classes of the global histograms
+SIZE_CLASSES = [1000, 10000, 100000, 1000000]
+
+EWMA_WEIGHT = 0.2 # weight of the newest duration in the moving average
+
+
+def size_class(n):
+    """ Label of the smallest size class holding a population of n ('+Inf' above all) """
+    if n is None:
+        return 'unknown'
+    i = bisect.bisect_left(SIZE_CLASSES, n)
+    return str(SIZE_CLASSES[i]) if i < len(SIZE_CLASSES) else '+Inf'
+
+
+class Histogram(object):
+    """ Cumulative histogram of durations, with their sum, count, the latest duration and
+        an exponentially weighted moving average """
+
+    def __init__(self):
+        self.counts = [0]*(len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self.ewma = None
+        self.n = None # population size at the latest observation
+
+    def observe(self, seconds, n=None):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.last = seconds
+        self.ewma = seconds if self.ewma is None else EWMA_WEIGHT*seconds + (1 - EWMA_WEIGHT)*self.ewma
+        if n is not None:
+            self.n = n
+
+    def cumulative(self):
+        """ Returns (upper bound, observations <= bound) pairs, ending with +Inf """
+        total = 0
+        out = []
+        for bound, c in zip(BUCKETS + ['+Inf'], self.counts):
+            total += c
+            out.append((bound, total))
+        return out
+
+
+class Timer(object):
+    """ Handle of one timed phase; set n to record the population size it worked on """
+
+    def __init__(self, n=None):
+        self.n = n
+
+
+class Metrics(object):
+    """ Thread-safe registry of phase histograms, global and per session """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = {}   # (phase, size class) -> Histogram
+        self._sessions = {} # session ID -> {phase: Histogram}
+        self._population = {} # session ID -> population size at the latest observation
+        self._calls = {}      # name -> calls
+        self._session_calls = {} # session ID -> {name: calls}
+
+    @contextmanager
+    def timer(self, phase, sid=None, n=None):
+        """ Times the body of a with statement as one observation of phase """
+        t = Timer(n)
+        start = time.perf_counter()
+        try:
+            yield t
+        finally:
+            self.observe(phase, time.perf_counter() - start, sid, t.n)
+
+    def timed(self, phase, sid_arg=None):
+        """ Decorator counting and timing every call of a function as one observation of
+            phase; the session ID is taken from positional argument sid_arg, if given """
+        def decorate(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                sid = args[sid_arg] if sid_arg is not None else None
+                self.count(phase, sid)
+                with self.timer(phase, sid):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def observe(self, phase, seconds, sid=None, n=None):
+        with self._lock:
+            key = (phase, size_class(n))
+            if key not in self._global:
+                self._global[key] = Histogram()
+            self._global[key].observe(seconds, n)
+            if sid is not None:
+                phases = self._sessions.setdefault(sid, {})
+                if phase not in phases:
+                    phases[phase] = Histogram()
+                phases[phase].observe(seconds, n)
+                if n is not None:
+                    self._population[sid] = n
+
+    def count(self, name, sid=None):
+        """ Counts one call of name, e.g. a callback or a model step """
+        with self._lock:
+            self._calls[name] = self._calls.get(name, 0) + 1
+            if sid is not None:
+                calls = self._session_calls.setdefault(sid, {})
+                calls[name] = calls.get(name, 0) + 1
+
+    def calls(self, sid):
+        """ Returns {name: calls} of a session """
+        with self._lock:
+            return dict(self._session_calls.get(sid, {}))
+
+    def session(self, sid):
+        """ Returns {phase: (moving average s, latest s, count, population size)} of a session """
+        with self._lock:
+            phases = self._sessions.get(sid, {})
+            return {p: (h.ewma, h.last, h.count, h.n) for p, h in phases.items()}
+
+    def drop(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+            self._population.pop(sid, None)
+            self._session_calls.pop(sid, None)
+
+    def render_prometheus(self):
+        """ Returns all metrics in the Prometheus text exposition format """
+        lines = ['# HELP ibm_phase_seconds Duration of IBM phases by population size class.',
+                 '# TYPE ibm_phase_seconds histogram']
+        with self._lock:
+            for (phase, size), h in sorted(self._global.items()):
+                labels = 'phase="%s",size="%s"' % (phase, size)
+                for bound, c in h.cumulative():
+                    lines.append('ibm_phase_seconds_bucket{%s,le="%s"} %d' % (labels, bound, c))
+                lines.append('ibm_phase_seconds_sum{%s} %.9g' % (labels, h.sum))
+                lines.append('ibm_phase_seconds_count{%s} %d' % (labels, h.count))
+
+            lines += ['# HELP ibm_session_phase_seconds Duration of IBM phases per session.',
+                      '# TYPE ibm_session_phase_seconds summary']
+            for sid, phases in sorted(self._sessions.items()):
+                for phase, h in sorted(phases.items()):
+                    labels = 'session="%s",phase="%s"' % (sid, phase)
+                    lines.append('ibm_session_phase_seconds_sum{%s} %.9g' % (labels, h.sum))
+                    lines.append('ibm_session_phase_seconds_count{%s} %d' % (labels, h.count))
+
+            lines += ['# HELP ibm_session_population Population size at the latest timed phase.',
+                      '# TYPE ibm_session_population gauge']
+            for sid, n in sorted(self._population.items()):
+                lines.append('ibm_session_population{session="%s"} %d' % (sid, n))
+
+            lines += ['# HELP ibm_calls_total Calls of callbacks and model steps.',
+                      '# TYPE ibm_calls_total counter']
+            for name, c in sorted(self._calls.items()):
+                lines.append('ibm_calls_total{name="%s"} %d' % (name, c))
+            lines += ['# HELP ibm_session_calls_total Calls of callbacks and model steps per session.',
+                      '# TYPE ibm_session_calls_total counter']
+            for sid, calls in sorted(self._session_calls.items()):
+                for name, c in sorted(calls.items()):
+                    lines.append('ibm_session_calls_total{session="%s",name="%s"} %d' % (sid, name, c))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
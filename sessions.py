@@ -0,0 +1,362 @@
+import copy
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from metrics import METRICS
+from ibm import IBMState, advance, save_checkpoint, load_checkpoint, DEFAULT_PARAMS as MODEL_PARAMS
+
+logger = logging.getLogger(__name__)
+
+#########################################################################################
+############################# BACKGROUND SIMULATION #####################################
+#########################################################################################
+
+DEFAULT_PARAMS = dict(MODEL_PARAMS, ticks = 1)
+
+HISTORY_LENGTH = 10000 # time steps of N, S and total resources kept per session
+
+FRAME_BUDGET = 0.2 # target time (s) between published frames
+
+RATE_WEIGHT = 0.2 # weight of the newest frame in the moving averages of latency and tick rate
+
+# columns of a session's time series
+SERIES_COLUMNS = ['tick', 'N', 'S', 'R']
+
+
+class RingBuffer(object):
+    """ Fixed-capacity buffer of rows. Appending is O(rows appended); once full, the
+        oldest rows are overwritten. """
+
+    def __init__(self, capacity, width):
+        self.data = np.zeros((capacity, width))
+        self.total = 0 # rows ever appended
+
+    @property
+    def capacity(self):
+        return self.data.shape[0]
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, self.data.shape[1])
+        rows = rows[-self.capacity:]
+        k = rows.shape[0]
+        self.data[(self.total + np.arange(k)) % self.capacity] = rows
+        self.total += k
+
+    def last(self, k):
+        """ Returns the last k rows (at most len(self)), oldest first """
+        k = min(k, len(self))
+        return self.data[(self.total - k + np.arange(k)) % self.capacity]
+
+    def clear(self):
+        self.total = 0
+
+class Frame(object):
+    """ Latest published view of a session: a copy of the community after `tick` time steps,
+        with its own copy of the RNG, and its N, S and total resources """
+
+    def __init__(self, tick, state, summary, index=0):
+        self.tick = tick
+        self.state = state
+        self.summary = summary
+        self.index = index # frames published by the session before and including this one
+
+
+class SimulationWorker(threading.Thread):
+    """ Advances the IBM of one session in a background thread, independent of how often
+        the browser asks for frames. Every `period` seconds the worker simulates
+        `params['ticks']` time steps and publishes a frame to its session. When that takes
+        longer than `period`, the next frame is started right away, so at most one is in
+        progress and frames simply arrive more slowly. The worker rests when no browser has
+        fetched a frame for `idle_timeout` seconds. `latency` and `tick_rate` are moving
+        averages of the time to simulate and publish a frame and of the time steps run per
+        second; the browser asks for frames every `frame_period()` seconds.
+
+        The UI talks to the worker only through commands:
+            ('params', dict)   update model parameters
+            ('pause', bool)    pause or resume the simulation
+            ('clear', bool)    drop the community and hold it empty; when released, a new
+                               community is built on the next time step
+            ('stop', None)     end the thread
+    """
+
+    def __init__(self, session, params=None, period=FRAME_BUDGET, idle_timeout=300):
+        threading.Thread.__init__(self, daemon=True)
+        self.session = session
+        self.params = dict(DEFAULT_PARAMS)
+        if params is not None:
+            self.params.update(params)
+        self.period = period
+        self.idle_timeout = idle_timeout
+        self.paused = False
+        self.cleared = False
+        self.commands = queue.Queue()
+        self.latency = 0.0
+        self.tick_rate = 0.0
+
+    def send(self, command, value=None):
+        self.commands.put((command, value))
+
+    def stop(self):
+        self.send('stop')
+
+    def _handle(self, command, value):
+        """ Applies one command. Returns False when the worker should stop """
+        session = self.session
+        if command == 'stop':
+            return False
+        elif command == 'params':
+            self.params.update(value)
+        elif command == 'pause':
+            self.paused = bool(value)
+        elif command == 'clear':
+            if value and not self.cleared:
+                session.reset()
+            self.cleared = bool(value)
+        return True
+
+    def idle(self):
+        """ True when no browser has fetched a frame for `idle_timeout` seconds """
+        return time.time() - self.session.last_seen > self.idle_timeout
+
+    def running(self):
+        return not (self.paused or self.cleared or self.idle())
+
+    def frame_period(self):
+        """ Expected time (s) between frames: the target period, or longer if steps are slow """
+        return max(self.period, self.latency)
+
+    def _update_rates(self, latency, ticks, elapsed):
+        w = RATE_WEIGHT
+        if self.tick_rate == 0:
+            self.latency, self.tick_rate = latency, ticks / elapsed
+        else:
+            self.latency = w*latency + (1 - w)*self.latency
+            self.tick_rate = w*ticks/elapsed + (1 - w)*self.tick_rate
+
+    def run(self):
+        while True:
+            # apply pending commands, blocking for the next one when paused or cleared; an
+            # idle worker also looks every period for a browser that has come back
+            try:
+                timeout = self.period if self.idle() else None
+                command, value = self.commands.get(block=not self.running(), timeout=timeout)
+                while True:
+                    if not self._handle(command, value):
+                        return
+                    command, value = self.commands.get_nowait()
+            except queue.Empty:
+                pass
+
+            if not self.running():
+                self.tick_rate = 0.0
+                continue
+
+            start = time.time()
+            tick = self.session.tick
+            try:
+                self.session.advance(self.params)
+            except Exception:
+                # a failed step (e.g. bad parameters) is logged and retried on the next
+                # period, so the worker outlives it and resumes once the cause is fixed
+                logger.exception('step of session %s failed', self.session.sid)
+            latency = time.time() - start
+            time.sleep(max(0, self.period - latency))
+            self._update_rates(latency, max(0, self.session.tick - tick), time.time() - start)
+
+#########################################################################################
+############################# SERVER-SIDE SESSION STORE #################################
+#########################################################################################
+
+class Session(object):
+    """ Simulation state of one browser session. The IBMState and the N, S and total
+        resource histories stay on the server; the browser only holds the session ID. """
+
+    def __init__(self, sid, history_length=HISTORY_LENGTH):
+        self.sid = sid
+        self.lock = threading.RLock()
+        self.state = None
+        self.tick = 0
+        self.epoch = 0 # incremented whenever the community and its time series are reset
+        self.series = RingBuffer(history_length, len(SERIES_COLUMNS))
+        self.frame = None
+        self.shown = None  # frame last fetched by the browser
+        self.published = 0 # frames published since the last reset
+        self.fetched = 0   # index of the last frame fetched by the browser
+        self.dropped = 0   # published frames the browser never fetched
+        self.polling = threading.Lock() # held while the browser's request for a frame runs
+        self.worker = None
+        self.last_seen = time.time()
+
+    def reset(self):
+        """ Drops the community; a new one is built on the next time step """
+        with self.lock:
+            self.state = None
+            self.tick = 0
+            self.epoch += 1
+            self.series.clear()
+            self.frame = None
+            self.shown = None
+            self.published = self.fetched = self.dropped = 0
+
+    def advance(self, params):
+        """ Simulates params['ticks'] time steps and publishes the final state. Only the
+            worker steps the live state, so the step and the copy for the frame run outside
+            the lock, which is only taken to swap in the frame and extend the time series.
+            A step during which the session was reset or restored is discarded """
+        with self.lock:
+            if self.state is None:
+                # new community of S randomly parameterized species, one individual each
+                self.state = IBMState.new(params['S'])
+            state, epoch = self.state, self.epoch
+
+        # the fused kernel is used when Numba is installed
+        METRICS.count('step', self.sid)
+        with METRICS.timer('step', self.sid) as t:
+            history = advance(state, params, max(1, int(params['ticks'])), jit=True)
+            t.n = state.n
+        with METRICS.timer('publish', self.sid, state.n):
+            shown = self._snapshot(state)
+            summary = state.summary()
+
+        with self.lock:
+            if self.epoch != epoch:
+                return
+            ticks = self.tick + 1 + np.arange(len(history))
+            self.series.extend(np.column_stack([ticks, history]))
+            self.tick += len(history)
+            self.published += 1
+            self.frame = Frame(self.tick, shown, summary, self.published)
+
+    @staticmethod
+    def _snapshot(state):
+        """ Copy of a state for a frame. Its RNG is copied too, so a frame can be saved and
+            continued exactly while the live state steps on """
+        shown = state.copy()
+        shown.rng = copy.deepcopy(state.rng)
+        return shown
+
+    def publish(self):
+        with self.lock:
+            if self.state is not None:
+                with METRICS.timer('publish', self.sid, self.state.n):
+                    self.published += 1
+                    self.frame = Frame(self.tick, self._snapshot(self.state),
+                                       self.state.summary(), self.published)
+
+    def fetch(self, since=None):
+        """ Returns the latest frame, which becomes the one shown, the rows of the time
+            series after tick `since` (up to the frame) and the epoch. Frames published
+            since the previous fetch and never fetched are counted as dropped """
+        with self.lock:
+            rows = self.series_rows(since)
+            if self.frame is not None and self.frame.index > self.fetched:
+                self.dropped += self.frame.index - self.fetched - 1
+                self.fetched = self.frame.index
+            self.shown = self.frame
+            return self.frame, rows, self.epoch
+
+    def series_rows(self, since=None, until=None):
+        """ Returns the time series rows (tick, N, S, R) with since < tick <= until """
+        with self.lock:
+            until = self.tick if until is None else min(until, self.tick)
+            since = 0 if since is None else since
+            rows = self.series.last(self.tick - since)
+            return rows[rows[:, 0] <= until]
+
+    def save(self, file):
+        """ Writes a checkpoint of the session as of its latest frame: the full model state
+            (including its RNG), the time series, the tick and the worker's parameters. The
+            frame is never stepped, so the file is written without waiting for a step """
+        with self.lock:
+            frame = self.frame
+            if frame is None:
+                raise ValueError('session %s has no community to save' % self.sid)
+            series = self.series.last(len(self.series))
+            params = dict(self.worker.params if self.worker is not None else DEFAULT_PARAMS)
+        save_checkpoint(file, frame.state,
+                        series = series,
+                        tick = np.array(frame.tick),
+                        params = np.array(json.dumps(params)))
+
+    def restore(self, file):
+        """ Replaces the community and time series with those of a checkpoint. Returns the
+            saved parameters, which are also passed on to the worker """
+        state, extra = load_checkpoint(file)
+        params = dict(DEFAULT_PARAMS, **json.loads(str(extra['params'])))
+        with self.lock:
+            self.reset()
+            self.state = state
+            self.tick = int(extra['tick'])
+            self.series.extend(extra['series'])
+            self.publish()
+            if self.worker is not None:
+                self.worker.send('params', params)
+        return params
+
+    def start_worker(self, params=None):
+        """ Returns the session's worker, starting a new one if there is none or it died """
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = SimulationWorker(self, params)
+            self.worker.start()
+        return self.worker
+
+    def stop_worker(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+
+class SessionStore(object):
+    """ Thread-safe map of session IDs to Sessions. Sessions that have not been touched
+        for `ttl` seconds are evicted when new sessions are created. """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def create(self):
+        """ Starts a new session and returns its ID """
+        sid = uuid.uuid4().hex
+        with self._lock:
+            self._evict()
+            self._sessions[sid] = Session(sid)
+        return sid
+
+    def get(self, sid):
+        """ Returns the session with the given ID, or None if it does not exist """
+        if sid is None:
+            return None
+        with self._lock:
+            session = self._sessions.get(sid)
+        if session is not None:
+            session.last_seen = time.time()
+        return session
+
+    def drop(self, sid):
+        with self._lock:
+            session = self._sessions.pop(sid, None)
+        if session is not None:
+            session.stop_worker()
+        METRICS.drop(sid)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for sid in [s for s, v in self._sessions.items() if v.last_seen < cutoff]:
+            self._sessions.pop(sid).stop_worker()
+            METRICS.drop(sid)
+
+
+SESSIONS = SessionStore()
@@ -0,0 +1,141 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from codec import CODECS, encode_state, decode_state
+from ibm import (IBMState, W, H, DEFAULT_PARAMS, advance, neighbor_pairs, save_checkpoint,
+                 load_checkpoint, split)
+
+
+def brute_force_pairs(x, y, rep, px, py, prep, radius):
+    near = ((x[:, None] - px[None, :])**2 + (y[:, None] - py[None, :])**2 <= radius**2)
+    near &= rep[:, None] == prep[None, :]
+    i, j = np.nonzero(near)
+    return set(zip(i.tolist(), j.tolist()))
+
+
+@pytest.mark.parametrize('radius', [0.5, 3, 7.3, 25, 200])
+def test_neighbor_pairs_match_brute_force(radius):
+    # points and parcels drift up to W + 20 before outflow
+    rng = np.random.default_rng(0)
+    n, m = 400, 150
+    x, y = rng.uniform(0, W + 20, n), rng.uniform(0, H, n)
+    px, py = rng.uniform(0, W + 20, m), rng.uniform(0, H, m)
+    rep, prep = rng.integers(0, 2, n), rng.integers(0, 2, m)
+
+    i, j = neighbor_pairs(x, y, rep, px, py, prep, radius)
+    pairs = list(zip(i.tolist(), j.tolist()))
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == brute_force_pairs(x, y, rep, px, py, prep, radius)
+
+
+def test_neighbor_pairs_past_the_outflow():
+    x, y = np.array([115.0]), np.array([10.0])
+    px, py = np.array([115.2]), np.array([10.0])
+    zero = np.zeros(1, dtype=np.int64)
+    i, j = neighbor_pairs(x, y, zero, px, py, zero, 3)
+    assert list(zip(i, j)) == [(0, 0)]
+
+
+def test_select_keeps_the_selected_rows_in_order():
+    state = IBMState.new(50, seed=1)
+    state.add_individuals(np.arange(50).repeat(3000) % 50, np.zeros(150000))
+    state.x[:] = np.arange(state.n)
+    keep = np.random.default_rng(2).random(state.n) < 0.5
+    expected = state.x[keep].copy()
+    state.select(keep)
+    assert np.array_equal(state.x, expected)
+
+
+def test_advance_a_copy_of_an_extinct_state():
+    state = IBMState.new(10, seed=0)
+    state.clear()
+    copy = state.copy()
+    advance(copy, DEFAULT_PARAMS, 1)
+    assert copy.n > 0
+
+
+def assert_same_individuals(a, b):
+    assert a.n == b.n
+    for f in IBMState.IND_FIELDS:
+        assert np.array_equal(getattr(a, f), getattr(b, f)), f
+
+
+def test_restored_checkpoint_advances_like_the_original():
+    state = IBMState.new(30, seed=3)
+    advance(state, DEFAULT_PARAMS, 20)
+    file = io.BytesIO()
+    save_checkpoint(file, state)
+    file.seek(0)
+    restored, extra = load_checkpoint(file)
+    assert extra == {}
+
+    history = advance(state, DEFAULT_PARAMS, 15)
+    assert advance(restored, DEFAULT_PARAMS, 15) == history
+    assert_same_individuals(state, restored)
+    assert np.array_equal(state.res_size, restored.res_size)
+
+
+def test_checkpoint_rejects_an_unknown_bit_generator():
+    arrays = IBMState.new(5, seed=0).to_arrays()
+    meta = json.loads(str(arrays['meta']))
+    meta['rng']['bit_generator'] = 'seed'
+    arrays['meta'] = np.array(json.dumps(meta))
+    with pytest.raises(ValueError):
+        IBMState.from_arrays(arrays)
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_codec_round_trip(codec):
+    state = IBMState.new(30, seed=4)
+    advance(state, DEFAULT_PARAMS, 20)
+    payload = json.loads(json.dumps(encode_state(state, codec)))
+    decoded = decode_state(payload)
+
+    # pandas writes JSON floats with 10 significant digits, so only binary is exact
+    same = np.array_equal if codec == 'binary' else lambda a, b: np.allclose(a, b, rtol=1e-9)
+    assert np.array_equal(decoded.sp_ids, state.sp_ids)
+    assert decoded.n == state.n
+    for f in IBMState.IND_FIELDS:
+        assert same(getattr(decoded, f), getattr(state, f)), f
+    assert same(decoded.res_x, state.res_x)
+    assert same(decoded.res_size, state.res_size)
+    if codec == 'binary':
+        assert decoded.rng.bit_generator.state == state.rng.bit_generator.state
+
+
+def test_merge_keeps_N_and_bounds_agents():
+    rng = np.random.default_rng(5)
+    state = IBMState.new(20, seed=5)
+    state.add_individuals(rng.integers(0, 20, 5000), rng.uniform(0, H, 5000))
+    state.x[:] = rng.uniform(0, W, state.n)
+    state.weight[:] = rng.integers(1, 50, state.n)
+    N, S, _ = state.summary()
+
+    state.merge(100)
+    assert state.n <= 100
+    assert state.summary()[:2] == (N, S)
+    assert state.summary()[0] == state.weight.sum()
+
+
+def test_split_keeps_N():
+    rng = np.random.default_rng(6)
+    w = rng.integers(1, 20, 1000)
+    cols = dict(weight = w.copy(), x = np.arange(1000.0))
+    success = split(rng, cols, 0.3)
+    assert cols['weight'].sum() == w.sum()
+    assert (cols['weight'] > 0).all()
+    assert success.shape[0] == cols['x'].shape[0]
+    # a split-off agent is a copy of the agent it came from
+    assert set(cols['x'][1000:]) <= set(cols['x'][:1000])
+
+
+def test_advance_with_max_agents():
+    state = IBMState.new(20, seed=7)
+    params = dict(DEFAULT_PARAMS, S = 20, max_agents = 200)
+    for _ in range(40):
+        (N, S, R), = advance(state, params, 1)
+        assert state.n <= 200
+        assert N == state.weight.sum() == state.summary()[0]